@@ -0,0 +1,254 @@
+"""
+Bộ đo hiệu năng các đường nóng của ứng dụng, chạy ngoài Streamlit: chỉ import financial_core (không import
+giao diện python.py nên không mở trang Streamlit, không cần google-genai).
+
+Dùng bảng cân đối kế toán tổng hợp (từ 50 tới 1.000.000 dòng, một hoặc nhiều công ty), đo thời gian
+và bộ nhớ đỉnh của: đọc Excel, process_financial_data, tra cứu chỉ tiêu, tính chỉ số, định dạng Styler,
+trang bảng hiển thị (table_view_rows + Arrow), dựng data_for_ai và job phân tích AI qua hàng đợi nền
+(AIJobQueue với client Gemini giả lập cục bộ). Kết quả in ra dạng JSON.
+
+Ví dụ:
+    python benchmark.py --sizes 50 1000 100000 --companies 50 --output bench_output.txt
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Bộ nhớ đệm phản hồi AI của lần đo ghi vào thư mục tạm, không đụng tới cache thật
+os.environ.setdefault("AI_CACHE_PATH", os.path.join(tempfile.mkdtemp(prefix="bench_ai_cache_"), "cache.sqlite3"))
+
+import financial_core as core  # noqa: E402
+
+# Các chỉ tiêu chuẩn rải đều trong bảng để phép tra cứu phải quét như với file thật
+KEY_LINE_ITEMS = [
+    ('A. TÀI SẢN NGẮN HẠN', 0.45),
+    ('Hàng tồn kho', 0.10),
+    ('TỔNG CỘNG TÀI SẢN', 1.00),
+    ('C. NỢ PHẢI TRẢ', 0.55),
+    ('I. Nợ ngắn hạn', 0.30),
+    ('D. VỐN CHỦ SỞ HỮU', 0.45),
+    ('Doanh thu thuần về bán hàng và cung cấp dịch vụ', 0.80),
+    ('Lợi nhuận sau thuế thu nhập doanh nghiệp', 0.06),
+]
+
+
+def styler_format(df_processed):
+    """Định dạng Styler như giao diện cũ: tiền cho các cột kỳ, % cho các cột tỷ lệ."""
+    fmt = {col: '{:.2f}%' for col in df_processed.columns if col.endswith('(%)')}
+    fmt.update({col: '{:,.0f}' for col in core.period_columns(df_processed)})
+    return fmt
+
+
+# ------------------- CLIENT GEMINI GIẢ LẬP -------------------
+class _MockResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class _MockModels:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(self.latency)
+        return _MockResponse(f"[mock {model}] nhận {len(str(contents))} ký tự")
+
+    def generate_content_stream(self, model, contents, config=None):
+        time.sleep(self.latency)
+        for part in ("[mock] ", "nhận xét ", "giả lập"):
+            yield _MockResponse(part)
+
+
+class MockGeminiClient:
+    """Thay genai.Client (dùng .models như core.gemini_models): không gọi mạng, trả lời sau một độ trễ cố định."""
+    latency = 0.0
+
+    def __init__(self, *args, **kwargs):
+        self.models = _MockModels(self.latency)
+
+
+# ------------------- DỮ LIỆU TỔNG HỢP -------------------
+def make_balance_sheet(n_rows, seed=0, periods=2):
+    """Bảng cân đối tổng hợp n_rows dòng: Chỉ tiêu | Năm trước | Năm sau, hoặc Chỉ tiêu | 2001 | … khi periods > 2."""
+    rng = np.random.default_rng(seed)
+    n_rows = max(n_rows, len(KEY_LINE_ITEMS))
+    tong_tai_san = 1_000_000_000.0
+    labels = np.array([f"Chỉ tiêu chi tiết {i}" for i in range(n_rows)], dtype=object)
+    # Mỗi kỳ tăng/giảm ngẫu nhiên so với kỳ trước
+    he_so = np.cumprod(np.hstack([np.ones((n_rows, 1)), rng.uniform(0.7, 1.4, (n_rows, periods - 1))]), axis=1)
+    values = (rng.uniform(0, tong_tai_san / max(n_rows, 10), (n_rows, 1)) * he_so).round()
+
+    positions = np.linspace(0, n_rows - 1, len(KEY_LINE_ITEMS)).astype(int)
+    for pos, (label, share) in zip(positions, KEY_LINE_ITEMS):
+        labels[pos] = label
+        values[pos] = tong_tai_san * share * 1.1 ** np.arange(periods)
+    names = ['Năm trước', 'Năm sau'] if periods == 2 else [str(2000 + i) for i in range(1, periods + 1)]
+    return pd.DataFrame({'Chỉ tiêu': labels, **dict(zip(names, values.T))})
+
+
+def to_excel_bytes(sheets):
+    """Ghi dict tên sheet -> DataFrame ra bytes .xlsx."""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer) as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, index=False)
+    return buffer.getvalue()
+
+
+# ------------------- ĐO -------------------
+def measure(fn, repeat, setup=None):
+    """
+    Chạy fn `repeat` lần để lấy thời gian (giây) tốt nhất/trung vị, rồi thêm một lần dưới tracemalloc
+    để lấy bộ nhớ đỉnh (MB); tách riêng vì tracemalloc làm chậm đáng kể phép đo thời gian.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return {
+        'wall_s_min': round(min(times), 6),
+        'wall_s_median': round(statistics.median(times), 6),
+        'peak_mb': round(peak, 3),
+    }
+
+
+def run_benchmarks(sizes, companies, repeat, max_excel_rows, max_styler_rows, periods=2):
+    """Chạy toàn bộ các phép đo (lõi không cache nên mỗi lần đo là một lần tính mới), trả về danh sách kết quả."""
+    # Cùng đường với nút "Yêu cầu AI Phân tích": nộp job vào hàng đợi nền rồi chờ job xong
+    jobs = core.AIJobQueue()
+    cache = core.ResponseCache(core.AI_CACHE_PATH, core.AI_CACHE_TTL_SECONDS, core.AI_CACHE_MAX_BYTES)
+    models = MockGeminiClient().models
+    salt = iter(range(10**9))
+
+    def run_ai_job(data_for_ai):
+        # Mỗi lần đo dùng nội dung khác nhau để luôn trượt bộ nhớ đệm phản hồi
+        data = f"{data_for_ai}\n#{next(salt)}"
+        key = cache.make_key(core.ANALYSIS_MODEL, core.ANALYSIS_PROMPT_TEMPLATE, data)
+        return jobs.wait(jobs.submit(key, core.run_ai_analysis, models, cache, key, core.build_analysis_prompt(data),
+                                     subscriber='bench'))
+
+    results = []
+
+    def record(case, n_rows, n_companies, stats):
+        results.append({'case': case, 'rows': n_rows, 'companies': n_companies, **stats})
+        print(f"{case:<28} rows={n_rows:>9,} companies={n_companies:>4} "
+              f"min={stats['wall_s_min']:.4f}s peak={stats['peak_mb']:.1f}MB", file=sys.stderr)
+
+    for n_rows in sizes:
+        df_raw = make_balance_sheet(n_rows, periods=periods)
+
+        if n_rows <= max_excel_rows:
+            content = to_excel_bytes({'Sheet1': df_raw})
+            record('excel_ingestion', n_rows, 1, measure(
+                lambda: core.read_financial_workbook(content), repeat))
+
+        record('process_financial_data', n_rows, 1, measure(
+            lambda: core.process_financial_data(df_raw.copy()), repeat))
+        df_processed = core.process_financial_data(df_raw.copy())
+        cot_ky = core.period_columns(df_processed)
+
+        record('line_item_index', n_rows, 1, measure(
+            lambda: core.build_line_item_index(df_processed['Chỉ tiêu']), repeat))
+        line_items = core.build_line_item_index(df_processed['Chỉ tiêu'])
+        record('line_item_lookups', n_rows, 1, measure(
+            lambda: [core.lookup_line_item(line_items, key) for key in core.LINE_ITEM_ALIASES], repeat))
+
+        positions = {key: [line_items['items'].get(key, np.nan)] for key in core.LINE_ITEM_ALIASES}
+        record('compute_ratios', n_rows, 1, measure(
+            lambda: core.compute_ratios(df_processed, positions, [''], numeric_cols=cot_ky), repeat))
+        df_ratios = core.compute_ratios(df_processed, positions, [''], numeric_cols=cot_ky).drop(
+            columns=['Công ty']).set_index('Mã chỉ số')
+
+        if n_rows <= max_styler_rows:
+            record('styler_format', n_rows, 1, measure(
+                lambda: df_processed.style.format(styler_format(df_processed)).to_html(), repeat))
+
+        # Đường hiển thị thay cho Styler: một trang chuyển sang Arrow, có và không có bộ lọc/top N
+        record('table_view_page', n_rows, 1, measure(
+            lambda: pa.Table.from_pandas(core.table_view_rows(df_processed)[0]), repeat))
+        record('table_view_filter_top_n', n_rows, 1, measure(
+            lambda: pa.Table.from_pandas(core.table_view_rows(df_processed, 'chi tiet 1', 'growth', 20)[0]), repeat))
+
+        record('data_for_ai', n_rows, 1, measure(
+            lambda: core.build_data_for_ai(df_processed, df_ratios, protected_rows=line_items['items'].values()), repeat))
+        data_for_ai, _ = core.build_data_for_ai(df_processed, df_ratios, protected_rows=line_items['items'].values())
+        record('ai_job_mock', n_rows, 1, measure(lambda: run_ai_job(data_for_ai), repeat))
+
+        if companies > 1:
+            rows_per_company = max(n_rows // companies, len(KEY_LINE_ITEMS))
+            sheets = {f"Cong ty {i}": make_balance_sheet(rows_per_company, seed=i, periods=periods)
+                      for i in range(companies)}
+            df_long = pd.concat(
+                [df.assign(**{'Công ty': name}) for name, df in sheets.items()], ignore_index=True
+            )[['Công ty', *df_raw.columns]]
+            total_rows = rows_per_company * companies
+
+            if total_rows <= max_excel_rows:
+                content = to_excel_bytes(sheets)
+                record('batch_excel_ingestion', total_rows, companies, measure(
+                    lambda: core.stack_company_sheets([('bench', core.read_financial_workbook(content, all_sheets=True))]),
+                    repeat))
+
+            record('process_financial_data_batch', total_rows, companies, measure(
+                lambda: core.process_financial_data_batch(df_long.copy()), repeat))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Đo hiệu năng quy trình xử lý và dựng prompt (không cần Streamlit server).")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 1_000, 10_000, 100_000, 1_000_000],
+                        help="Số dòng của bảng cân đối tổng hợp.")
+    parser.add_argument('--periods', type=int, default=2, help="Số kỳ số liệu mỗi bảng (2 = Năm trước | Năm sau).")
+    parser.add_argument('--companies', type=int, default=20, help="Số công ty cho các phép đo hàng loạt (1 để bỏ qua).")
+    parser.add_argument('--repeat', type=int, default=3, help="Số lần lặp mỗi phép đo.")
+    parser.add_argument('--max-excel-rows', type=int, default=100_000,
+                        help="Chỉ đo đọc Excel tới kích thước này (ghi file .xlsx lớn rất chậm).")
+    parser.add_argument('--max-styler-rows', type=int, default=100_000, help="Chỉ đo Styler tới kích thước này.")
+    parser.add_argument('--mock-latency', type=float, default=0.0, help="Độ trễ (giây) của client Gemini giả lập.")
+    parser.add_argument('--output', help="Ghi JSON ra file thay vì stdout.")
+    args = parser.parse_args(argv)
+
+    MockGeminiClient.latency = args.mock_latency
+
+    report = {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'excel_engine': core.EXCEL_ENGINE or 'default',
+        'repeat': args.repeat,
+        'periods': args.periods,
+        'results': run_benchmarks(args.sizes, args.companies, args.repeat,
+                                  args.max_excel_rows, args.max_styler_rows, args.periods),
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
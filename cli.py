@@ -0,0 +1,201 @@
+"""
+Chạy phân tích báo cáo tài chính không cần Streamlit, cho các lượt xử lý hàng loạt (ví dụ chạy đêm).
+
+Mỗi file Excel trong thư mục được xử lý trong một tiến trình con riêng (ProcessPoolExecutor): đọc mọi sheet
+(mỗi sheet là một công ty như chế độ hàng loạt của ứng dụng), tính tăng trưởng, tỷ trọng, chỉ số tài chính
+rồi ghi ra <tên file>.processed và <tên file>.ratios (Parquet hoặc CSV); tên file giữ cả đuôi
+(ACB.xlsx.processed.parquet) để ACB.xlsx và ACB.xls cùng thư mục không ghi đè nhau. Với --ai, mỗi công ty được
+Gemini nhận xét (ghi ra <tên file>.ai), dùng chung bộ nhớ đệm phản hồi với ứng dụng; quota --rpm (mặc định
+GEMINI_RPM) chia đều cho các tiến trình, mỗi tiến trình giới hạn bằng token bucket. google-genai chỉ được import
+khi bật --ai. Bảng tóm tắt từng file ghi ra summary.csv trong thư mục kết quả.
+
+Ví dụ:
+    python cli.py data/bctc --output out --format parquet --workers 8
+    GEMINI_API_KEY=... python cli.py data/bctc --output out --ai
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import financial_core as core
+
+EXCEL_SUFFIXES = ('.xlsx', '.xlsm', '.xls')
+
+
+def find_workbooks(directory, recursive=False):
+    """Các file Excel trong thư mục (bỏ file khoá tạm '~$' của Excel), sắp theo đường dẫn."""
+    if recursive:
+        paths = [os.path.join(root, name) for root, _, names in os.walk(directory) for name in names]
+    else:
+        paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+    return sorted(
+        path for path in paths
+        if os.path.isfile(path) and path.lower().endswith(EXCEL_SUFFIXES) and not os.path.basename(path).startswith('~$')
+    )
+
+
+def write_table(df, path_without_suffix, fmt):
+    """Ghi bảng ra Parquet hoặc CSV (UTF-8 có BOM để Excel mở đúng tiếng Việt); trả về đường dẫn đã ghi."""
+    path = f"{path_without_suffix}.{fmt}"
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False, encoding='utf-8-sig')
+    return path
+
+
+class RateLimitedModels:
+    """
+    Bọc client Gemini (models) để mỗi lời gọi thật đều lấy một token của core.TokenBucket trên vòng lặp sự kiện
+    `loop`; gọi từ luồng phụ (asyncio.to_thread). Câu trả lời lấy từ bộ nhớ đệm không tốn token.
+    """
+
+    def __init__(self, models, bucket, loop):
+        self._models = models
+        self._bucket = bucket
+        self._loop = loop
+
+    def generate_content(self, **kwargs):
+        asyncio.run_coroutine_threadsafe(self._bucket.acquire(), self._loop).result()
+        return self._models.generate_content(**kwargs)
+
+
+# Vòng lặp sự kiện và token bucket của tiến trình con: quota là của cả tiến trình, không làm mới theo từng file
+_process_ai = {}
+
+
+def process_rate_limiter(rpm):
+    """(vòng lặp sự kiện, token bucket) dùng chung cho mọi file mà tiến trình con này xử lý."""
+    if not _process_ai:
+        _process_ai.update(loop=asyncio.new_event_loop(), bucket=core.TokenBucket(rpm))
+    return _process_ai['loop'], _process_ai['bucket']
+
+
+async def analyze_ai_async(items, api_key, bucket):
+    """Nhận xét của Gemini cho từng công ty (tuần tự trong tiến trình con) trong giới hạn bucket, ưu tiên bộ nhớ đệm phản hồi."""
+    models = RateLimitedModels(core.gemini_models(api_key), bucket, asyncio.get_running_loop())
+    cache = core.ResponseCache(core.AI_CACHE_PATH, core.AI_CACHE_TTL_SECONDS, core.AI_CACHE_MAX_BYTES)
+    rows = []
+    for cong_ty, data_for_ai in items:
+        started = time.perf_counter()
+        try:
+            text, cache_hit = await asyncio.to_thread(
+                core.run_ai_analysis,
+                models,
+                cache,
+                cache.make_key(core.ANALYSIS_MODEL, core.ANALYSIS_PROMPT_TEMPLATE, data_for_ai),
+                core.build_analysis_prompt(data_for_ai)
+            )
+            rows.append({'Công ty': cong_ty, 'Trạng thái': 'ok', 'Bộ nhớ đệm': cache_hit, 'Nhận xét': text})
+        except Exception as e:
+            rows.append({'Công ty': cong_ty, 'Trạng thái': 'error', 'Bộ nhớ đệm': False, 'Nhận xét': f"{type(e).__name__}: {e}"})
+        rows[-1]['Thời gian (s)'] = round(time.perf_counter() - started, 2)
+    return rows
+
+
+def analyze_ai(df_processed, df_ratios, api_key, token_budget, rpm=core.GEMINI_RPM):
+    """Chạy analyze_ai_async cho các công ty của một file; rpm là phần quota của tiến trình này."""
+    items = core.build_batch_ai_items(df_processed, df_ratios, token_budget=token_budget)
+    loop, bucket = process_rate_limiter(rpm)
+    return pd.DataFrame(loop.run_until_complete(analyze_ai_async(items, api_key, bucket)))
+
+
+def analyze_workbook(path, input_dir, output_dir, fmt='parquet', ai=False, token_budget=core.AI_PROMPT_TOKEN_BUDGET,
+                     rpm=core.GEMINI_RPM):
+    """
+    Xử lý trọn một file trong tiến trình con và ghi kết quả ra đĩa; chỉ trả về dòng tóm tắt nhỏ cho tiến trình
+    chính nên không phải gửi DataFrame qua lại giữa các tiến trình. Lỗi của một file không làm dừng các file khác.
+    """
+    started = time.perf_counter()
+    relative = os.path.relpath(path, input_dir)
+    ten_file = os.path.splitext(os.path.basename(relative))[0]
+    summary = {'file': relative, 'status': 'ok', 'companies': 0, 'rows': 0,
+               'periods': '', 'ai_errors': 0, 'seconds': 0.0, 'error': ''}
+    try:
+        # Giữ đuôi file trong tên kết quả: A.xlsx và A.xls cùng thư mục không ghi đè lên nhau
+        out_base = os.path.join(output_dir, relative)
+        os.makedirs(os.path.dirname(out_base), exist_ok=True)
+
+        sheets = core.read_financial_workbook(path, all_sheets=True)
+        df_long = core.stack_company_sheets([(ten_file, sheets)])
+        df_processed, df_ratios = core.process_financial_data_batch(df_long)
+        write_table(df_processed, f"{out_base}.processed", fmt)
+        write_table(df_ratios, f"{out_base}.ratios", fmt)
+        summary.update(
+            companies=len(df_ratios),
+            rows=len(df_processed),
+            periods=' | '.join(core.period_columns(df_processed))
+        )
+
+        if ai:
+            df_ai = analyze_ai(df_processed, df_ratios, os.environ['GEMINI_API_KEY'], token_budget, rpm=rpm)
+            write_table(df_ai, f"{out_base}.ai", fmt)
+            summary['ai_errors'] = int((df_ai['Trạng thái'] != 'ok').sum())
+    except Exception as e:
+        summary.update(status='error', error=f"{type(e).__name__}: {e}")
+    summary['seconds'] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+def run(paths, input_dir, output_dir, workers, rpm=core.GEMINI_RPM, **options):
+    """
+    Chạy analyze_workbook cho mọi file trên pool tiến trình; quota rpm chia đều cho các tiến trình để tổng số lời gọi
+    Gemini không vượt quota. In tiến độ ra stderr, trả về danh sách tóm tắt.
+    """
+    summaries = []
+    workers = max(1, min(workers, len(paths)))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(analyze_workbook, path, input_dir, output_dir, rpm=rpm / workers, **options)
+                   for path in paths]
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries.append(summary)
+            print(f"[{len(summaries)}/{len(paths)}] {summary['status']:<5} {summary['file']} "
+                  f"({summary['companies']} công ty, {summary['rows']:,} dòng, {summary['seconds']:.2f}s)"
+                  + (f" - {summary['error']}" if summary['error'] else ""), file=sys.stderr)
+    return sorted(summaries, key=lambda s: s['file'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input_dir', help="Thư mục chứa các file Excel báo cáo tài chính.")
+    parser.add_argument('--output', '-o', default='output', help="Thư mục ghi kết quả (mặc định: output).")
+    parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet', help="Định dạng file kết quả.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Số tiến trình xử lý song song.")
+    parser.add_argument('--recursive', action='store_true', help="Tìm cả file trong thư mục con (giữ cấu trúc thư mục ở kết quả).")
+    parser.add_argument('--ai', action='store_true', help="Gọi Gemini nhận xét từng công ty (cần biến môi trường GEMINI_API_KEY).")
+    parser.add_argument('--token-budget', type=int, default=core.AI_PROMPT_TOKEN_BUDGET,
+                        help="Ngân sách token cho dữ liệu gửi AI của mỗi công ty.")
+    parser.add_argument('--rpm', type=float, default=core.GEMINI_RPM,
+                        help="Quota số yêu cầu Gemini mỗi phút của khoá API, chia đều cho các tiến trình (mặc định GEMINI_RPM).")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.input_dir):
+        parser.error(f"Không tìm thấy thư mục: {args.input_dir}")
+    if args.ai and not os.environ.get('GEMINI_API_KEY'):
+        parser.error("--ai cần biến môi trường GEMINI_API_KEY.")
+    if args.rpm <= 0:
+        parser.error("--rpm phải lớn hơn 0.")
+    paths = find_workbooks(args.input_dir, recursive=args.recursive)
+    if not paths:
+        parser.error(f"Không có file Excel nào trong {args.input_dir}.")
+
+    os.makedirs(args.output, exist_ok=True)
+    started = time.perf_counter()
+    summaries = run(paths, args.input_dir, args.output, args.workers, rpm=args.rpm,
+                    fmt=args.format, ai=args.ai, token_budget=args.token_budget)
+    summary_path = write_table(pd.DataFrame(summaries), os.path.join(args.output, 'summary'), 'csv')
+
+    so_loi = sum(s['status'] != 'ok' for s in summaries)
+    print(f"Xong {len(summaries)} file ({so_loi} lỗi) trong {time.perf_counter() - started:.2f}s; tóm tắt: {summary_path}",
+          file=sys.stderr)
+    return 1 if so_loi else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
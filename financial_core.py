@@ -0,0 +1,1025 @@
+"""
+Lõi phân tích báo cáo tài chính, không phụ thuộc Streamlit: đọc Excel, tra cứu chỉ tiêu, tính tăng trưởng,
+tỷ trọng, chỉ số tài chính, dựng dữ liệu gửi AI, bộ nhớ đệm phản hồi Gemini, lọc/phân trang bảng lớn,
+chỉ mục truy xuất và lịch sử cho chat, giới hạn tốc độ gọi API và hàng đợi job chạy nền.
+
+python.py (giao diện) và cli.py (chạy hàng loạt) cùng dùng module này. Import nhẹ: chỉ numpy và pandas;
+google-genai chỉ được import khi thực sự gọi AI (gemini_models).
+"""
+import asyncio
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import posixpath
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+# ------------------- HÀM CHỈ MỤC CHỈ TIÊU -------------------
+# Bảng bí danh: mỗi chỉ tiêu chuẩn ứng với các cách ghi thường gặp (đã bỏ dấu, chữ thường)
+LINE_ITEM_ALIASES = {
+    'tong_tai_san': ['tong cong tai san', 'tong tai san', 'total assets'],
+    'tai_san_ngan_han': ['tai san ngan han', 'tai san luu dong', 'current assets'],
+    'no_ngan_han': ['no ngan han', 'current liabilities'],
+    'hang_ton_kho': ['hang ton kho', 'inventories', 'inventory'],
+    'no_phai_tra': ['no phai tra', 'tong no phai tra', 'total liabilities'],
+    'von_chu_so_huu': ['von chu so huu', 'tong von chu so huu', 'total equity', 'equity'],
+    'doanh_thu_thuan': ['doanh thu thuan', 'doanh thu thuan ve ban hang va cung cap dich vu', 'net revenue', 'revenue'],
+    'loi_nhuan_sau_thue': ['loi nhuan sau thue', 'loi nhuan sau thue thu nhap doanh nghiep', 'net income', 'net profit'],
+}
+
+def fold_text(text):
+    """Bỏ dấu, chữ thường, gộp ký hiệu thành khoảng trắng (câu tìm kiếm, tên công ty, tiêu đề kỳ)."""
+    s = unicodedata.normalize('NFD', str(text))
+    s = ''.join(c for c in s if unicodedata.category(c) != 'Mn')
+    s = s.replace('đ', 'd').replace('Đ', 'D').lower()
+    return re.sub(r'[^a-z0-9]+', ' ', s).strip()
+
+def normalize_label(text):
+    """Chuẩn hoá nhãn chỉ tiêu: như fold_text, bỏ thêm tiền tố đánh số (A., I., 100...)."""
+    return re.sub(r'^(?:[ivx]+|[a-z]|\d+) ', '', fold_text(text))
+
+def normalize_labels(labels, normalize=normalize_label):
+    """Chuẩn hoá cả cột nhãn (mặc định normalize_label), mỗi nhãn khác nhau chỉ xử lý một lần."""
+    labels = labels.fillna('').astype(str)
+    uniques = labels.unique()
+    return labels.map(dict(zip(uniques, map(normalize, uniques))))
+
+def _line_item_masks(normalized):
+    """Với mỗi chỉ tiêu chuẩn: (mặt nạ khớp chính xác bí danh, mặt nạ chứa bí danh)."""
+    masks = {}
+    for key, aliases in LINE_ITEM_ALIASES.items():
+        pattern = r'\b(?:' + '|'.join(map(re.escape, aliases)) + r')\b'
+        masks[key] = (normalized.isin(aliases), normalized.str.contains(pattern, regex=True))
+    return masks
+
+def build_line_item_index(labels):
+    """
+    Dựng chỉ mục chỉ tiêu một lần cho mỗi file: nhãn đã chuẩn hoá -> vị trí dòng,
+    và chỉ tiêu chuẩn (theo LINE_ITEM_ALIASES) -> vị trí dòng. Ưu tiên khớp chính xác, sau đó khớp chứa.
+    """
+    normalized = normalize_labels(pd.Series(labels).reset_index(drop=True))
+    index = {'labels': {}, 'items': {}}
+    for pos, label in enumerate(normalized):
+        index['labels'].setdefault(label, pos)
+
+    for key, (exact, contains) in _line_item_masks(normalized).items():
+        hit = exact if exact.any() else contains
+        if hit.any():
+            index['items'][key] = int(hit.to_numpy().argmax())
+    return index
+
+def lookup_line_item(index, key):
+    """Tra vị trí dòng theo chỉ tiêu chuẩn hoặc theo nhãn bất kỳ; trả về None nếu không có."""
+    if key in index['items']:
+        return index['items'][key]
+    return index['labels'].get(normalize_label(key))
+
+def build_line_item_index_batch(df_long):
+    """Chỉ mục chỉ tiêu cho bảng nhiều công ty: mỗi dòng là một công ty, mỗi cột là vị trí dòng của chỉ tiêu chuẩn."""
+    normalized = normalize_labels(df_long['Chỉ tiêu'].reset_index(drop=True))
+    cong_ty = df_long['Công ty'].reset_index(drop=True)
+    positions = pd.Series(range(len(df_long)))
+    cac_cong_ty = pd.Index(cong_ty.unique(), name='Công ty')
+
+    index = pd.DataFrame(index=cac_cong_ty)
+    for key, (exact, contains) in _line_item_masks(normalized).items():
+        first_exact = positions[exact].groupby(cong_ty[exact]).first()
+        first_contains = positions[contains].groupby(cong_ty[contains]).first()
+        index[key] = first_exact.combine_first(first_contains).reindex(cac_cong_ty)
+    return index
+
+# ------------------- BỘ MÁY CHỈ SỐ TÀI CHÍNH -------------------
+# Sổ đăng ký chỉ số: mỗi chỉ số khai báo đầu vào (chỉ tiêu chuẩn hoặc chỉ số khác) và công thức trên mảng
+RATIO_REGISTRY = {}
+
+def register_ratio(name, label, inputs, formula, unit='lần'):
+    """Đăng ký một chỉ số; formula nhận các mảng numpy theo đúng thứ tự inputs."""
+    RATIO_REGISTRY[name] = {'label': label, 'inputs': list(inputs), 'formula': formula, 'unit': unit}
+
+def _chia(tu_so, mau_so):
+    """Phép chia theo phần tử, mẫu số bằng 0 hoặc thiếu thì trả NaN."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(mau_so != 0, tu_so / mau_so, np.nan)
+
+register_ratio('thanh_toan_hien_hanh', 'Thanh toán hiện hành', ['tai_san_ngan_han', 'no_ngan_han'], _chia)
+register_ratio('thanh_toan_nhanh', 'Thanh toán nhanh', ['tai_san_ngan_han', 'hang_ton_kho', 'no_ngan_han'],
+               lambda tsnh, htk, nnh: _chia(tsnh - htk, nnh))
+register_ratio('no_tren_von', 'Nợ / Vốn chủ sở hữu', ['no_phai_tra', 'von_chu_so_huu'], _chia)
+register_ratio('roa', 'ROA', ['loi_nhuan_sau_thue', 'tong_tai_san'], lambda ln, ts: _chia(ln, ts) * 100, unit='%')
+register_ratio('roe', 'ROE', ['loi_nhuan_sau_thue', 'von_chu_so_huu'], lambda ln, vcsh: _chia(ln, vcsh) * 100, unit='%')
+register_ratio('vong_quay_tai_san', 'Vòng quay tổng tài sản', ['doanh_thu_thuan', 'tong_tai_san'], _chia, unit='vòng')
+register_ratio('don_bay_tai_chinh', 'Đòn bẩy tài chính (ROE / ROA)', ['roe', 'roa'], _chia)
+
+def resolve_ratio_order(names=None):
+    """Sắp xếp topo các chỉ số theo phụ thuộc; trả về (thứ tự tính, danh sách chỉ tiêu cần đọc)."""
+    order, line_items, visiting = [], set(), set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Phụ thuộc vòng giữa các chỉ số tại '{name}'.")
+        visiting.add(name)
+        for dep in RATIO_REGISTRY[name]['inputs']:
+            if dep in RATIO_REGISTRY:
+                visit(dep)
+            elif dep in LINE_ITEM_ALIASES:
+                line_items.add(dep)
+            else:
+                raise ValueError(f"Chỉ số '{name}' dùng chỉ tiêu chưa khai báo: '{dep}'.")
+        visiting.discard(name)
+        order.append(name)
+
+    for name in (names or RATIO_REGISTRY):
+        visit(name)
+    return order, sorted(line_items)
+
+def _line_item_matrix(df, positions, numeric_cols):
+    """Gom giá trị các năm của một chỉ tiêu theo vị trí dòng (NaN nếu thiếu): mảng (số công ty, số năm)."""
+    positions = np.asarray(positions, dtype=float)
+    values = df[numeric_cols].to_numpy(dtype=float)
+    out = np.full((len(positions), len(numeric_cols)), np.nan)
+    found = ~np.isnan(positions)
+    out[found] = values[positions[found].astype(int)]
+    return out
+
+def compute_ratios(df, positions_by_item, entities, numeric_cols=('Năm trước', 'Năm sau'), names=None):
+    """
+    Tính mọi chỉ số đã đăng ký cho mọi công ty và mọi năm bằng phép toán trên cả mảng.
+    positions_by_item: chỉ tiêu chuẩn -> vị trí dòng của chỉ tiêu đó ở từng công ty (theo thứ tự entities).
+    Trả về bảng dài: Công ty | Mã chỉ số | Chỉ số | Đơn vị | các cột năm.
+    """
+    numeric_cols = list(numeric_cols)
+    order, line_items = resolve_ratio_order(names)
+
+    values = {key: _line_item_matrix(df, positions_by_item[key], numeric_cols) for key in line_items}
+    for name in order:
+        spec = RATIO_REGISTRY[name]
+        values[name] = spec['formula'](*(values[dep] for dep in spec['inputs']))
+
+    entities = list(entities)
+    df_ratios = pd.DataFrame(np.concatenate([values[name] for name in order]), columns=numeric_cols)
+    df_ratios.insert(0, 'Công ty', entities * len(order))
+    df_ratios.insert(1, 'Mã chỉ số', np.repeat(order, len(entities)))
+    df_ratios.insert(2, 'Chỉ số', np.repeat([RATIO_REGISTRY[n]['label'] for n in order], len(entities)))
+    df_ratios.insert(3, 'Đơn vị', np.repeat([RATIO_REGISTRY[n]['unit'] for n in order], len(entities)))
+    return df_ratios
+
+# ------------------- CHUỖI NHIỀU KỲ (MA TRẬN SỐ LIỆU THEO KỲ) -------------------
+# Báo cáo hai kỳ giữ tên cột cũ; nhiều kỳ (5–20 năm, theo quý…) giữ tiêu đề cột của file, xếp cũ → mới
+DEFAULT_PERIODS = ['Năm trước', 'Năm sau']
+ROLLING_WINDOW = int(os.environ.get("ROLLING_WINDOW", 3))
+
+def period_columns(df):
+    """Các cột kỳ của bảng (cũ → mới): lấy từ df.attrs['periods'] nếu có, nếu không là mọi cột trừ nhãn và công ty."""
+    periods = df.attrs.get('periods')
+    if periods is None:
+        periods = [col for col in df.columns if col not in ('Chỉ tiêu', 'Công ty')]
+    return list(periods)
+
+def _period_sort_key(period):
+    """Khoá xếp các kỳ không có thứ tự ràng buộc: theo năm (số 4 chữ số) rồi các số còn lại (quý, tháng…)."""
+    so = re.findall(r'\d+', str(period))
+    return (tuple(int(x) for x in so if len(x) == 4), tuple(int(x) for x in so if len(x) != 4))
+
+def merge_period_orders(period_lists):
+    """
+    Gộp danh sách kỳ của nhiều công ty thành một thứ tự cũ → mới: giữ thứ tự trong từng công ty (sắp xếp topo),
+    các kỳ không ràng buộc với nhau (ví dụ hai công ty có giai đoạn rời nhau) xếp theo năm trong tiêu đề.
+    """
+    period_lists = [list(periods) for periods in period_lists]
+    xuat_hien, truoc = {}, {}
+    for periods in period_lists:
+        for i, period in enumerate(periods):
+            xuat_hien.setdefault(period, len(xuat_hien))
+            truoc.setdefault(period, set())
+            if i > 0:
+                truoc[period].add(periods[i - 1])
+
+    merged = []
+    while len(merged) < len(xuat_hien):
+        san_sang = [p for p in xuat_hien if p not in merged and truoc[p] <= set(merged)]
+        if not san_sang:
+            raise ValueError("Thứ tự kỳ giữa các công ty mâu thuẫn nhau.")
+        merged.append(min(san_sang, key=lambda p: (_period_sort_key(p), xuat_hien[p])))
+    return merged
+
+def company_periods(df, cong_ty):
+    """Các kỳ có số liệu của một công ty trong bảng hàng loạt (df.attrs['company_periods']); mặc định mọi kỳ của bảng."""
+    return list(df.attrs.get('company_periods', {}).get(cong_ty, period_columns(df)))
+
+def _period_time(period):
+    """
+    Thời điểm (theo năm, có phần lẻ) của một kỳ đọc từ tiêu đề cột: 2023, FY2023, Q2/2023, Quý 2 2023, T6/2023,
+    06/2023, 2023-06…; None nếu tiêu đề không chứa đúng một năm hoặc không rõ là quý/tháng nào.
+    """
+    s = fold_text(period)
+    nam = re.findall(r'(?<!\d)(?:19|20)\d\d(?!\d)', s)
+    if len(nam) != 1:
+        return None
+    con_lai = s.replace(nam[0], ' ', 1)
+    if not re.search(r'\d', con_lai):
+        return float(nam[0])
+    quy = re.fullmatch(r'\s*(?:q|quy)\s*([1-4])\s*|\s*([1-4])\s*q\s*', con_lai)
+    if quy:
+        return int(nam[0]) + (int(quy.group(1) or quy.group(2)) - 1) / 4
+    thang = re.fullmatch(r'\s*(?:t|m|thang)?\s*(\d{1,2})\s*', con_lai)
+    if thang and 1 <= int(thang.group(1)) <= 12:
+        return int(nam[0]) + (int(thang.group(1)) - 1) / 12
+    return None
+
+def elapsed_years(periods):
+    """
+    Số năm từ kỳ đầu tới kỳ cuối theo tiêu đề kỳ (năm, quý, tháng) để quy CAGR về tỷ lệ năm; None khi có kỳ không
+    đọc được thời điểm hoặc các kỳ không tăng dần (khi đó chỉ tính được tăng trưởng kép mỗi kỳ).
+    """
+    thoi_diem = [_period_time(p) for p in periods]
+    if len(thoi_diem) < 2 or None in thoi_diem or any(b <= a for a, b in zip(thoi_diem, thoi_diem[1:])):
+        return None
+    return thoi_diem[-1] - thoi_diem[0]
+
+CAGR_COLUMN = 'CAGR (%)'
+PERIOD_CAGR_COLUMN = 'Tăng trưởng kép mỗi kỳ (%)'
+
+def cagr_column(periods):
+    """Tên cột tăng trưởng kép: CAGR (theo năm) khi đọc được thời điểm các kỳ, nếu không là tăng trưởng kép mỗi kỳ."""
+    return CAGR_COLUMN if elapsed_years(periods) else PERIOD_CAGR_COLUMN
+
+def growth_column(period):
+    """Tên cột tăng trưởng của một kỳ so với kỳ liền trước."""
+    return f"Tăng trưởng {period} (%)"
+
+def weight_column(period):
+    """Tên cột tỷ trọng trên Tổng tài sản của một kỳ."""
+    return f"Tỷ trọng {period} (%)"
+
+def rolling_column(period, window=ROLLING_WINDOW):
+    """Tên cột trung bình trượt `window` kỳ, kết thúc tại kỳ này."""
+    return f"TB {window} kỳ {period}"
+
+def period_metrics(values, tong_tai_san, window=ROLLING_WINDOW, so_nam=None):
+    """
+    Chỉ số theo kỳ trên ma trận giá trị (số dòng × số kỳ), tính một lượt dọc trục kỳ:
+    tăng trưởng so với kỳ trước (%), tăng trưởng kép cả giai đoạn (%), trung bình trượt `window` kỳ và tỷ trọng trên
+    Tổng tài sản (%). tong_tai_san phát theo hàng được: (1 × số kỳ) hoặc (số dòng × số kỳ).
+    so_nam (từ elapsed_years) quy tăng trưởng kép về tỷ lệ năm (CAGR); None thì là tỷ lệ mỗi kỳ.
+    """
+    truoc = values[:, :-1]
+    tang_truong = (values[:, 1:] - truoc) / np.where(truoc == 0, 1e-9, truoc) * 100
+
+    # Quý/tháng: quy về năm theo thời gian thực giữa hai kỳ, không theo số kỳ
+    so_buoc = so_nam or values.shape[1] - 1
+    dau, cuoi = values[:, 0], values[:, -1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cagr = np.where((dau > 0) & (cuoi > 0), (cuoi / dau) ** (1 / so_buoc) - 1, np.nan) * 100
+
+    # Trung bình trượt qua tổng tích luỹ: cột j là trung bình các kỳ j-window+1..j
+    tich_luy = np.cumsum(np.pad(values, ((0, 0), (1, 0))), axis=1)
+    trung_binh_truot = (tich_luy[:, window:] - tich_luy[:, :-window]) / window if values.shape[1] >= window else values[:, :0]
+
+    ty_trong = values / np.where(tong_tai_san == 0, 1e-9, tong_tai_san) * 100
+    return {'growth': tang_truong, 'latest_growth': tang_truong[:, -1], 'cagr': cagr,
+            'rolling': trung_binh_truot, 'weight': ty_trong}
+
+def assemble_period_frame(base, periods, values, metrics, window=ROLLING_WINDOW):
+    """
+    Ghép ma trận giá trị và các chỉ số theo kỳ thành bảng phân tích (một khối số, không thêm cột từng cái một).
+    'Tốc độ tăng trưởng (%)' luôn là tăng trưởng của kỳ mới nhất; tăng trưởng từng kỳ, tăng trưởng kép (cột theo
+    cagr_column) và trung bình trượt chỉ thêm khi có hơn hai kỳ. Danh sách kỳ lưu ở out.attrs['periods'].
+    """
+    khoi, ten_cot = [values, metrics['latest_growth'][:, None]], [*periods, 'Tốc độ tăng trưởng (%)']
+    if len(periods) > 2:
+        khoi.append(metrics['growth'])
+        ten_cot += [growth_column(p) for p in periods[1:]]
+    khoi.append(metrics['weight'])
+    ten_cot += [weight_column(p) for p in periods]
+    if len(periods) > 2:
+        khoi += [metrics['cagr'][:, None], metrics['rolling']]
+        ten_cot += [cagr_column(periods), *(rolling_column(p, window) for p in periods[window - 1:])]
+
+    out = pd.concat([base, pd.DataFrame(np.hstack(khoi), columns=ten_cot, index=base.index)], axis=1)
+    out.attrs['periods'] = list(periods)
+    return out
+
+# ------------------- HÀM TÍNH TOÁN (MỘT BÁO CÁO) -------------------
+def process_financial_data(df):
+    """Thực hiện các phép tính Tăng trưởng và Tỷ trọng (cùng CAGR, trung bình trượt khi có nhiều kỳ)."""
+    periods = period_columns(df)
+    values = df[periods].apply(pd.to_numeric, errors='coerce').fillna(0).to_numpy(dtype='float64')
+
+    pos_tong_tai_san = lookup_line_item(build_line_item_index(df['Chỉ tiêu']), 'tong_tai_san')
+    if pos_tong_tai_san is None:
+        raise ValueError("Không tìm thấy chỉ tiêu 'TỔNG CỘNG TÀI SẢN'.")
+
+    metrics = period_metrics(values, values[pos_tong_tai_san], so_nam=elapsed_years(periods))
+    return assemble_period_frame(df[['Chỉ tiêu']], periods, values, metrics)
+
+# ------------------- HÀM ĐỌC FILE EXCEL -------------------
+# calamine (Rust) đọc nhanh hơn openpyxl nhiều lần; chưa cài python-calamine thì pandas tự chọn engine mặc định
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') else None
+# Cột mã số / thuyết minh hay có trong BCTC: không phải kỳ số liệu
+NON_PERIOD_HEADERS = {'ma so', 'ma', 'thuyet minh', 'tm'}
+
+def _read_financial_sheet(xls, sheet_name):
+    """
+    Đọc cột nhãn và các cột kỳ (trái → phải là cũ → mới), ép kiểu cố định: nhãn là chuỗi, giá trị là float64.
+    Đúng hai kỳ thì đặt tên 'Năm trước' | 'Năm sau' như trước; nhiều kỳ thì giữ tiêu đề cột (2019, Q1/2024…).
+    """
+    df = xls.parse(sheet_name)
+    headers = [str(col).strip() for col in df.columns[1:]]
+    values = df.iloc[:, 1:].apply(pd.to_numeric, errors='coerce').astype('float64')
+    giu = [
+        i for i, header in enumerate(headers)
+        if normalize_label(header) not in NON_PERIOD_HEADERS
+        and not (header.startswith('Unnamed') and values.iloc[:, i].isna().all())
+    ]
+    if len(giu) < 2:
+        raise ValueError("Sheet cần cột Chỉ tiêu và ít nhất hai kỳ số liệu.")
+
+    periods = DEFAULT_PERIODS if len(giu) == 2 else [
+        f"Kỳ {n + 1}" if headers[i].startswith('Unnamed') else headers[i] for n, i in enumerate(giu)
+    ]
+    values = values.iloc[:, giu].set_axis(periods, axis=1)
+    out = pd.concat([df.iloc[:, 0].astype('string').rename('Chỉ tiêu'), values], axis=1)
+    out.attrs['periods'] = list(periods)
+    return out
+
+def read_financial_workbook(source, all_sheets=False):
+    """
+    Đọc file Excel báo cáo tài chính từ đường dẫn hoặc nội dung (bytes). all_sheets=True trả về
+    dict tên sheet -> DataFrame, bỏ qua sheet không đủ cột Chỉ tiêu và hai kỳ số liệu.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with pd.ExcelFile(source, engine=EXCEL_ENGINE) as xls:
+        if not all_sheets:
+            return _read_financial_sheet(xls, 0)
+
+        sheets = {}
+        for sheet_name in xls.sheet_names:
+            try:
+                sheets[sheet_name] = _read_financial_sheet(xls, sheet_name)
+            except ValueError:
+                continue
+        return sheets
+
+# ------------------- HÀM XỬ LÝ HÀNG LOẠT (NHIỀU CÔNG TY) -------------------
+def company_file_keys(file_names):
+    """
+    Tên công ty theo từng file: đường dẫn tương đối (bỏ đuôi, bỏ thư mục chung của mọi file) để file trùng tên ở
+    các thư mục khác nhau (2023/ACB.xlsx, 2024/ACB.xlsx) không bị gộp thành một công ty.
+    """
+    names = [name.replace('\\', '/').rsplit('.', 1)[0] for name in file_names]
+    chung = posixpath.commonpath([posixpath.dirname(name) for name in names]) if names else ''
+    return [posixpath.relpath(name, chung) if chung else name for name in names]
+
+def stack_company_sheets(workbooks):
+    """
+    Xếp chồng các sheet đã đọc thành một bảng dài theo 'Công ty'. workbooks: các cặp (tên file, dict sheet -> DataFrame);
+    mỗi sheet là một công ty, file một sheet thì lấy tên file.
+    """
+    frames, da_co = [], set()
+    for ten_file, sheets in workbooks:
+        for ten_sheet, df_sheet in sheets.items():
+            cong_ty = ten_file if len(sheets) == 1 else f"{ten_file} - {ten_sheet}"
+            # Hai bảng cùng tên công ty sẽ bị gộp nhầm khi tính theo nhóm (dùng chung Tổng tài sản, vị trí chỉ tiêu)
+            if cong_ty in da_co:
+                raise ValueError(f"Trùng tên công ty '{cong_ty}': đổi tên file/sheet để mỗi công ty có tên riêng.")
+            da_co.add(cong_ty)
+            df_sheet = df_sheet.copy()
+            df_sheet.insert(0, 'Công ty', cong_ty)
+            frames.append(df_sheet)
+
+    if not frames:
+        raise ValueError("Không có sheet nào đủ cột Chỉ tiêu và ít nhất hai kỳ số liệu.")
+    periods = merge_period_orders(period_columns(df_sheet) for df_sheet in frames)
+    df_long = pd.concat(frames, ignore_index=True)[['Công ty', 'Chỉ tiêu', *periods]]
+    df_long.attrs['periods'] = periods
+    # Kỳ riêng của từng công ty: các kỳ công ty không có để trống (NaN), không tính vào tăng trưởng/CAGR
+    df_long.attrs['company_periods'] = {
+        df_sheet['Công ty'].iat[0]: period_columns(df_sheet) for df_sheet in frames if len(df_sheet)
+    }
+    return df_long
+
+def _batch_period_metrics(df_long, periods, tong_tai_san, window=ROLLING_WINDOW):
+    """
+    period_metrics cho bảng nhiều công ty, mỗi công ty trên đúng các kỳ của nó: tính theo từng nhóm công ty có
+    cùng danh sách kỳ rồi trải về các cột kỳ chung; kỳ công ty không có là NaN. Tăng trưởng kép quy về năm
+    khi cột chung là CAGR (cagr_column của các kỳ chung), nếu không là tỷ lệ mỗi kỳ cho mọi công ty.
+    """
+    theo_nam = cagr_column(periods) == CAGR_COLUMN
+    values = df_long[periods].to_numpy(dtype='float64')
+    n, so_ky = values.shape
+    metrics = {
+        'growth': np.full((n, so_ky - 1), np.nan),
+        'latest_growth': np.full(n, np.nan),
+        'cagr': np.full(n, np.nan),
+        'rolling': np.full((n, max(so_ky - window + 1, 0)), np.nan),
+        'weight': np.full((n, so_ky), np.nan),
+    }
+    cong_ty = df_long['Công ty'].to_numpy()
+    nhom = {}
+    for ten in pd.unique(cong_ty):
+        nhom.setdefault(tuple(company_periods(df_long, ten)), []).append(ten)
+
+    for ky_rieng, cac_cong_ty in nhom.items():
+        dong = np.flatnonzero(np.isin(cong_ty, cac_cong_ty))
+        cot = np.array([periods.index(p) for p in ky_rieng])
+        m = period_metrics(values[np.ix_(dong, cot)], tong_tai_san[np.ix_(dong, cot)], window,
+                           so_nam=elapsed_years(ky_rieng) if theo_nam else None)
+        metrics['weight'][np.ix_(dong, cot)] = m['weight']
+        metrics['growth'][np.ix_(dong, cot[1:] - 1)] = m['growth']
+        metrics['rolling'][np.ix_(dong, cot[window - 1:] - (window - 1))] = m['rolling']
+        metrics['latest_growth'][dong] = m['latest_growth']
+        metrics['cagr'][dong] = m['cagr']
+    return metrics
+
+def process_financial_data_batch(df_long):
+    """
+    Tính Tăng trưởng, Tỷ trọng (và CAGR, trung bình trượt khi có nhiều kỳ) cùng toàn bộ chỉ số tài chính
+    cho mọi công ty trong một lượt (vector hoá theo nhóm). Mỗi công ty tính trên các kỳ của chính nó
+    (df.attrs['company_periods']); ô trống trong các kỳ đó coi là 0, kỳ công ty không có để NaN.
+    """
+    numeric_cols = period_columns(df_long)
+    df_long = df_long.reset_index(drop=True)
+    values = df_long[numeric_cols].apply(pd.to_numeric, errors='coerce').to_numpy(dtype='float64')
+    co_ky = np.zeros(values.shape, dtype=bool)
+    for ten, dong in df_long.groupby('Công ty', sort=False).indices.items():
+        co_ky[np.ix_(dong, [numeric_cols.index(p) for p in company_periods(df_long, ten)])] = True
+    df_long[numeric_cols] = np.where(co_ky, np.nan_to_num(values, nan=0.0), np.nan)
+
+    # Chỉ mục chỉ tiêu dựng một lần cho toàn bộ bảng dài
+    line_items = build_line_item_index_batch(df_long)
+
+    thieu = line_items.index[line_items['tong_tai_san'].isna()]
+    if len(thieu) > 0:
+        raise ValueError(f"Không tìm thấy chỉ tiêu 'TỔNG CỘNG TÀI SẢN' của: {', '.join(map(str, thieu))}.")
+
+    positions = {key: line_items[key].to_numpy() for key in LINE_ITEM_ALIASES}
+
+    # Mẫu số Tổng tài sản của từng công ty, phát lại cho mọi dòng của công ty đó
+    tong_tai_san = pd.DataFrame(
+        _line_item_matrix(df_long, positions['tong_tai_san'], numeric_cols), index=line_items.index
+    ).reindex(df_long['Công ty']).to_numpy()
+    df_processed = assemble_period_frame(
+        df_long[['Công ty', 'Chỉ tiêu']], numeric_cols, df_long[numeric_cols].to_numpy(dtype='float64'),
+        _batch_period_metrics(df_long, numeric_cols, tong_tai_san)
+    )
+    df_processed.attrs['company_periods'] = {ten: company_periods(df_long, ten) for ten in line_items.index}
+
+    # Toàn bộ chỉ số của mọi công ty, trải ngang: "<Chỉ số> (<Năm>)"
+    df_ratios = compute_ratios(df_long, positions, line_items.index, numeric_cols=numeric_cols).pivot(
+        index='Công ty', columns='Chỉ số', values=numeric_cols
+    )
+    cot_chi_so = [(nam, spec['label']) for spec in RATIO_REGISTRY.values() for nam in numeric_cols]
+    df_ratios = df_ratios.reindex(columns=cot_chi_so)
+    df_ratios.columns = [f"{chi_so} ({nam})" for nam, chi_so in cot_chi_so]
+    df_ratios = df_ratios.reindex(line_items.index).reset_index()
+
+    return df_processed, df_ratios
+
+# ------------------- HÀM DỰNG DỮ LIỆU GỬI AI (THEO NGÂN SÁCH TOKEN) -------------------
+AI_PROMPT_TOKEN_BUDGET = int(os.environ.get("AI_PROMPT_TOKEN_BUDGET", 4000))
+
+def ai_prompt_columns(periods, cot_cagr=None):
+    """
+    Cột gửi cho AI và số chữ số thập phân giữ lại: kỳ mới nhất, tăng trưởng, tỷ trọng hai kỳ cuối (và cột tăng trưởng
+    kép nếu nhiều kỳ; mặc định theo cagr_column(periods)).
+    """
+    columns = {
+        periods[-1]: 0,
+        'Tốc độ tăng trưởng (%)': 1,
+        weight_column(periods[-2]): 1,
+        weight_column(periods[-1]): 1,
+    }
+    if len(periods) > 2:
+        columns[cot_cagr or cagr_column(periods)] = 1
+    return columns
+
+def estimate_tokens(text):
+    """Ước lượng số token (~3 ký tự/token với tiếng Việt có dấu), đủ để khống chế kích thước prompt."""
+    return -(-len(text) // 3)
+
+def rank_scores(df, rank_by='weight'):
+    """Điểm xếp hạng từng dòng: tỷ trọng lớn nhất qua các kỳ (rank_by='weight') hoặc |tốc độ tăng trưởng| kỳ mới nhất (rank_by='growth')."""
+    if rank_by == 'growth':
+        diem = df['Tốc độ tăng trưởng (%)'].abs()
+    else:
+        diem = df[[weight_column(p) for p in period_columns(df)]].abs().max(axis=1)
+    return np.array(diem.fillna(0), dtype=float)
+
+def build_data_for_ai(df_processed, df_ratios=None, token_budget=AI_PROMPT_TOKEN_BUDGET, rank_by='weight', protected_rows=()):
+    """
+    Mã hoá gọn bảng phân tích thành CSV đã làm tròn (chỉ các cột cần cho nhận xét) kèm bảng chỉ số.
+    Nếu vượt ngân sách token, giữ các dòng quan trọng (protected_rows) rồi tới các dòng có tỷ trọng
+    (rank_by='weight') hoặc tốc độ tăng trưởng (rank_by='growth') lớn nhất.
+    Trả về (văn bản, thông tin kích thước).
+    """
+    periods = period_columns(df_processed)
+    # Bảng hàng loạt giữ tên cột tăng trưởng kép của các kỳ chung, có thể khác cagr_column của riêng công ty
+    cot_cagr = next((c for c in (CAGR_COLUMN, PERIOD_CAGR_COLUMN) if c in df_processed.columns), None)
+    cot_ai = ai_prompt_columns(periods, cot_cagr)
+    phan_dau = []
+    if df_ratios is not None:
+        bang_chi_so = df_ratios[['Chỉ số', 'Đơn vị', *periods]].round(2)
+        phan_dau.append("Chỉ số tài chính (CSV):\n" + bang_chi_so.to_csv(index=False, lineterminator='\n'))
+
+    bang = df_processed[['Chỉ tiêu', *cot_ai]].reset_index(drop=True)
+    bang['Chỉ tiêu'] = bang['Chỉ tiêu'].fillna('').astype(str).str.replace(r'\s+', ' ', regex=True).str.strip()
+    bang = bang.round(cot_ai).astype({col: 'int64' for col, so_le in cot_ai.items() if so_le == 0})
+    dong = bang.to_csv(index=False, header=False, lineterminator='\n').splitlines()
+
+    # Điểm ưu tiên của từng dòng; dòng quan trọng luôn đứng đầu
+    diem = rank_scores(df_processed, rank_by)
+    diem[[p for p in protected_rows if p is not None]] = np.inf
+    thu_tu = np.argsort(-diem, kind='stable')
+
+    con_lai = token_budget - estimate_tokens(''.join(phan_dau) + ','.join(bang.columns))
+    token_dong = np.array([estimate_tokens(d) + 1 for d in dong], dtype=int)
+    giu = thu_tu[np.cumsum(token_dong[thu_tu]) <= max(con_lai, 0)]
+    giu = np.sort(np.union1d(giu, thu_tu[:(diem == np.inf).sum()]).astype(int))
+
+    tieu_chi = 'tỷ trọng' if rank_by != 'growth' else 'tốc độ tăng trưởng'
+    ghi_chu = f"đủ {len(dong)} dòng" if len(giu) == len(dong) else f"giữ {len(giu)}/{len(dong)} dòng lớn nhất theo {tieu_chi}"
+    phan_dau.append(
+        f"Bảng phân tích (CSV; {periods[-1]} làm tròn đơn vị, các cột % làm tròn 1 chữ số; "
+        + (f"{'CAGR (theo năm)' if CAGR_COLUMN in cot_ai else 'tăng trưởng kép mỗi kỳ'} tính từ {periods[0]} tới {periods[-1]}; "
+           if len(periods) > 2 else "")
+        + f"{ghi_chu}):\n"
+        + ','.join(bang.columns) + '\n' + '\n'.join(dong[i] for i in giu)
+    )
+    data_for_ai = '\n\n'.join(phan_dau)
+    return data_for_ai, {
+        'tokens': estimate_tokens(data_for_ai),
+        'chars': len(data_for_ai),
+        'rows_kept': len(giu),
+        'rows_total': len(dong),
+    }
+
+def build_batch_ai_items(df_batch, df_batch_ratios, token_budget=AI_PROMPT_TOKEN_BUDGET):
+    """Dữ liệu gửi AI cho từng công ty của chế độ hàng loạt: danh sách (tên công ty, data_for_ai)."""
+    ratios = df_batch_ratios.set_index('Công ty')
+    items = []
+    for cong_ty, df_cong_ty in df_batch.groupby('Công ty', sort=False):
+        # Mỗi công ty mô tả theo kỳ của chính nó (kỳ mới nhất, tỷ trọng hai kỳ cuối…)
+        periods = company_periods(df_batch, cong_ty)
+        df_cong_ty = df_cong_ty.reset_index(drop=True)
+        df_cong_ty.attrs = {'periods': periods}
+        hang = ratios.loc[cong_ty]
+        df_ratios = pd.DataFrame([
+            {
+                'Chỉ số': spec['label'],
+                'Đơn vị': spec['unit'],
+                **{ky: hang[f"{spec['label']} ({ky})"] for ky in periods},
+            }
+            for spec in RATIO_REGISTRY.values()
+        ])
+        line_items = build_line_item_index(df_cong_ty['Chỉ tiêu'])
+        data_for_ai, _ = build_data_for_ai(
+            df_cong_ty, df_ratios, token_budget=token_budget, protected_rows=line_items['items'].values()
+        )
+        items.append((cong_ty, data_for_ai))
+    return items
+
+# ------------------- HÀM GỌI GEMINI CHO PHÂN TÍCH TÓM TẮT -------------------
+ANALYSIS_MODEL = 'gemini-2.5-flash'
+
+ANALYSIS_PROMPT_TEMPLATE = """
+        Bạn là một chuyên gia phân tích tài chính chuyên nghiệp. Dựa trên các chỉ số tài chính sau, hãy đưa ra một nhận xét khách quan, ngắn gọn (khoảng 3-4 đoạn) về tình hình tài chính của doanh nghiệp. Đánh giá tập trung vào tốc độ tăng trưởng, thay đổi cơ cấu tài sản và khả năng thanh toán hiện hành.
+        
+        Dữ liệu thô và chỉ số:
+        {data_for_ai}
+        """
+
+def build_analysis_prompt(data_for_ai):
+    """Ghép dữ liệu phân tích vào prompt nhận xét tài chính."""
+    return ANALYSIS_PROMPT_TEMPLATE.format(data_for_ai=data_for_ai)
+
+def run_ai_analysis(client, cache, cache_key, prompt, config=None):
+    """
+    Nhận xét của Gemini cho prompt, ưu tiên bộ nhớ đệm: trả về (text, cache_hit).
+    client cần có generate_content(model=, contents=, config=); config (tuỳ chọn) là GenerateContentConfig của SDK.
+    """
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached, True
+
+    response = client.generate_content(
+        model=ANALYSIS_MODEL,
+        contents=prompt,
+        config=config
+    )
+    if response.text:
+        cache.set(cache_key, response.text)
+    return response.text, False
+
+def gemini_models(api_key):
+    """Client Gemini đơn giản cho chạy ngoài Streamlit (dùng với run_ai_analysis); google-genai chỉ được import tại đây."""
+    from google import genai
+    return genai.Client(api_key=api_key).models
+
+# ------------------- BỘ NHỚ ĐỆM PHẢN HỒI AI -------------------
+AI_CACHE_PATH = os.environ.get("AI_CACHE_PATH", os.path.join(".cache", "gemini_responses.sqlite3"))
+AI_CACHE_TTL_SECONDS = int(os.environ.get("AI_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+AI_CACHE_MAX_BYTES = int(os.environ.get("AI_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+
+class ResponseCache:
+    """Bộ nhớ đệm phản hồi Gemini trên SQLite: dùng chung giữa các phiên, còn sau khi khởi động lại, hết hạn theo TTL và loại bỏ LRU khi vượt dung lượng."""
+
+    def __init__(self, path, ttl_seconds, max_bytes):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def make_key(model, template, content):
+        """Khoá = SHA-256 của tên model, mẫu prompt và nội dung gửi đi."""
+        payload = json.dumps([model, template, content], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Trả về phản hồi đã lưu (và đánh dấu vừa dùng), hoặc None nếu không có/đã hết hạn."""
+        now = time.time()
+        with self._lock, closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND created >= ?",
+                (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value):
+        """Lưu phản hồi, xoá mục hết hạn rồi loại bỏ mục lâu không dùng nhất cho tới khi dưới giới hạn dung lượng."""
+        now = time.time()
+        size = len(value.encode('utf-8'))
+        with self._lock, closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now)
+            )
+            conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS running FROM responses)"
+                " WHERE running > ?)",
+                (self.max_bytes,)
+            )
+
+    def stats(self):
+        """Số lần trúng/trượt trong tiến trình này cùng số mục và dung lượng đang lưu."""
+        with closing(self._connect()) as conn:
+            entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': total,
+        }
+
+# ------------------- BẢNG LỚN (LỌC, TOP N, PHÂN TRANG) -------------------
+TABLE_PAGE_SIZE = int(os.environ.get("TABLE_PAGE_SIZE", 200))
+
+def table_search_labels(df):
+    """Nhãn đã chuẩn hoá (normalize_labels) dùng để lọc bảng, kèm tên công ty nếu có."""
+    nhan = normalize_labels(df['Chỉ tiêu'])
+    if 'Công ty' in df.columns:
+        nhan = normalize_labels(df['Công ty'], fold_text) + ' ' + nhan
+    return nhan.to_numpy()
+
+def table_view_rows(df, query='', view='all', top_n=None, page=1, page_size=TABLE_PAGE_SIZE, search_labels=None):
+    """
+    Một trang của bảng: lọc chỉ tiêu (không phân biệt dấu; search_labels là table_search_labels(df) nếu đã có sẵn),
+    tuỳ chọn chỉ giữ top N dòng theo tỷ trọng/tốc độ tăng trưởng (view='weight'/'growth'), rồi cắt trang.
+    Trả về (các dòng của trang, số dòng khớp).
+    """
+    vi_tri = np.arange(len(df))
+    tu_khoa = fold_text(query) if query else ''
+    if tu_khoa:
+        nhan = table_search_labels(df) if search_labels is None else search_labels
+        vi_tri = vi_tri[pd.Series(nhan).str.contains(tu_khoa, regex=False).to_numpy()]
+    if view != 'all' and top_n:
+        diem = rank_scores(df.iloc[vi_tri], rank_by=view)
+        vi_tri = vi_tri[np.argsort(-diem, kind='stable')[:top_n]]
+
+    trang = vi_tri[(page - 1) * page_size:page * page_size]
+    return df.iloc[trang], len(vi_tri)
+
+# ------------------- CHỈ MỤC TRUY XUẤT CỤC BỘ CHO CHAT (TF-IDF, KHÔNG CẦN MẠNG) -------------------
+CHAT_RETRIEVAL_TOP_K = int(os.environ.get("CHAT_RETRIEVAL_TOP_K", 8))
+# Độ tương đồng cosine tối thiểu để một dòng được gửi kèm (câu chào hỏi không kéo theo dữ liệu)
+CHAT_RETRIEVAL_MIN_SCORE = float(os.environ.get("CHAT_RETRIEVAL_MIN_SCORE", 0.15))
+
+def _retrieval_terms(text):
+    """
+    Các âm tiết (đã bỏ dấu) và cặp âm tiết liền nhau: tiếng Việt ghép từ theo âm tiết nên bigram phân biệt
+    "no ngan han" với "tai san ngan han" tốt hơn n-gram ký tự. Bỏ các token chỉ gồm chữ số.
+    """
+    words = [w for w in text.split() if not w.isdigit()]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+def _statement_documents(df_processed, df_ratios=None):
+    """
+    Mỗi dòng chỉ tiêu và mỗi chỉ số là một tài liệu: (phần để so khớp, nội dung gửi kèm cho mô hình).
+    Chỉ so khớp trên tên (công ty, chỉ tiêu, chỉ số), đã chuẩn hoá như khi tra cứu chỉ tiêu (normalize_labels);
+    nội dung gửi kèm có số liệu các kỳ và các chỉ số tính được.
+    """
+    periods = period_columns(df_processed)
+    co_cong_ty = 'Công ty' in df_processed.columns
+    cong_ty = df_processed['Công ty'].astype(str) + ' | ' if co_cong_ty else ''
+    nhan = cong_ty + df_processed['Chỉ tiêu'].fillna('').astype(str).str.strip()
+    khop = normalize_labels(df_processed['Chỉ tiêu'])
+    if co_cong_ty:
+        khop = normalize_labels(df_processed['Công ty'], fold_text) + ' ' + khop
+
+    # Bảng hàng loạt: kỳ công ty không có là NaN, bỏ khỏi nội dung; tỷ trọng lấy ở kỳ cuối có số liệu của từng dòng
+    so_lieu = pd.Series('', index=df_processed.index)
+    for ky in periods:
+        so_lieu = so_lieu + df_processed[ky].map('{:,.0f}'.format).radd(f"; {ky} ").where(df_processed[ky].notna(), '')
+    noi_dung = nhan + ': ' + so_lieu.str[2:]
+    noi_dung = noi_dung + df_processed['Tốc độ tăng trưởng (%)'].map('{:.1f}%'.format).radd("; tăng trưởng ")
+    ty_trong = df_processed[[weight_column(ky) for ky in periods]].to_numpy(dtype='float64')
+    ky_cuoi = len(periods) - 1 - (~np.isnan(ty_trong))[:, ::-1].argmax(axis=1)
+    noi_dung = (
+        noi_dung + "; tỷ trọng " + pd.Series(np.array(periods, dtype=object)[ky_cuoi], index=df_processed.index)
+        + pd.Series(ty_trong[np.arange(len(ky_cuoi)), ky_cuoi], index=df_processed.index).map(' {:.1f}%'.format)
+    )
+    if CAGR_COLUMN in df_processed.columns:
+        noi_dung = noi_dung + df_processed[CAGR_COLUMN].map('{:.1f}%'.format).radd("; CAGR ")
+    elif PERIOD_CAGR_COLUMN in df_processed.columns:
+        noi_dung = noi_dung + df_processed[PERIOD_CAGR_COLUMN].map('{:.1f}%'.format).radd("; tăng trưởng kép mỗi kỳ ")
+    so_khop, gui_kem = khop.tolist(), noi_dung.tolist()
+
+    if df_ratios is not None:
+        # Bảng chỉ số dạng dài (một công ty) hoặc trải ngang "<Chỉ số> (<Kỳ>)" theo công ty (hàng loạt)
+        if 'Chỉ số' in df_ratios.columns:
+            hang_chi_so = [(None, row) for _, row in df_ratios.iterrows()]
+        else:
+            hang_chi_so = [
+                (row['Công ty'], {
+                    'Chỉ số': spec['label'], 'Đơn vị': spec['unit'],
+                    **{ky: row[f"{spec['label']} ({ky})"] for ky in company_periods(df_processed, row['Công ty'])},
+                })
+                for _, row in df_ratios.iterrows() for spec in RATIO_REGISTRY.values()
+            ]
+        for ten, row in hang_chi_so:
+            gia_tri = "; ".join(
+                f"{ky} {row[ky]:.2f}" if pd.notna(row[ky]) else f"{ky} N/A"
+                for ky in periods if ky in row
+            )
+            tien_to = '' if ten is None else f"{ten} | "
+            so_khop.append(('' if ten is None else fold_text(ten) + ' ') + normalize_label(row['Chỉ số']))
+            gui_kem.append(f"{tien_to}Chỉ số {row['Chỉ số']} ({row['Đơn vị']}): {gia_tri}")
+    return so_khop, gui_kem
+
+def build_statement_index(df_processed, df_ratios=None):
+    """
+    Chỉ mục TF-IDF (âm tiết + cặp âm tiết, chuẩn hoá L2) trên các dòng chỉ tiêu và chỉ số của báo cáo.
+    Lưu dạng chỉ mục ngược bằng mảng numpy: postings của term t nằm trong docs/weights[term_ptr[t]:term_ptr[t + 1]].
+    """
+    so_khop, gui_kem = _statement_documents(df_processed, df_ratios)
+    vocab, doc_ids, term_ids = {}, [], []
+    for doc_id, text in enumerate(so_khop):
+        for term in _retrieval_terms(text):
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            doc_ids.append(doc_id)
+
+    n_docs, n_terms = len(gui_kem), len(vocab)
+    # Đếm tần suất (tài liệu, term) và sắp theo term để có chỉ mục ngược
+    cap, tf = np.unique(np.asarray(term_ids, dtype=np.int64) * n_docs + np.asarray(doc_ids, dtype=np.int64), return_counts=True)
+    term_of, doc_of = np.divmod(cap, n_docs)
+    df_term = np.bincount(term_of, minlength=n_terms)
+    idf = np.log((1 + n_docs) / (1 + df_term)) + 1
+    weights = (1 + np.log(tf)) * idf[term_of]
+    weights /= np.sqrt(np.bincount(doc_of, weights=weights ** 2, minlength=n_docs))[doc_of]
+
+    return {
+        'vocab': vocab,
+        'idf': idf,
+        'term_ptr': np.concatenate([[0], np.cumsum(df_term)]),
+        'docs': doc_of,
+        'weights': weights,
+        'texts': gui_kem,
+    }
+
+def search_statement_index(index, query, top_k=CHAT_RETRIEVAL_TOP_K, min_score=CHAT_RETRIEVAL_MIN_SCORE):
+    """Các dòng gần câu hỏi nhất theo cosine TF-IDF: danh sách (điểm, nội dung), điểm giảm dần."""
+    terms = {}
+    for term in _retrieval_terms(fold_text(query)):
+        if term in index['vocab']:
+            terms[index['vocab'][term]] = terms.get(index['vocab'][term], 0) + 1
+    if not terms:
+        return []
+
+    term_ids = np.fromiter(terms, dtype=np.int64)
+    q_weights = (1 + np.log(np.fromiter(terms.values(), dtype=float))) * index['idf'][term_ids]
+    q_weights /= np.linalg.norm(q_weights)
+
+    starts, ends = index['term_ptr'][term_ids], index['term_ptr'][term_ids + 1]
+    postings = np.concatenate([np.arange(a, b) for a, b in zip(starts, ends)])
+    scores = np.bincount(
+        index['docs'][postings],
+        weights=index['weights'][postings] * np.repeat(q_weights, ends - starts),
+        minlength=len(index['texts'])
+    )
+    top = np.argsort(-scores, kind='stable')[:top_k]
+    return [(float(scores[i]), index['texts'][i]) for i in top if scores[i] >= min_score]
+
+def retrieval_context(source, hits):
+    """Khối dữ liệu báo cáo gửi kèm câu hỏi: chỉ các dòng liên quan nhất."""
+    return (
+        f"Dữ liệu liên quan từ báo cáo đã tải lên ({source}); chỉ dùng nếu phù hợp với câu hỏi:\n"
+        + "\n".join(f"- {text}" for _, text in hits)
+    )
+
+# ------------------- LỊCH SỬ CHAT (NGÂN SÁCH TOKEN) -------------------
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", 2000))
+
+def split_chat_history(turns, token_budget, summarized_count=0):
+    """
+    Chia lịch sử thành (lượt cũ, lượt gần đây): lượt gần đây được giữ nguyên văn trong ngân sách token
+    (luôn gồm lượt cuối và bắt đầu bằng lượt của người dùng); các lượt đã tóm tắt không gửi lại.
+    """
+    cut, used = len(turns), 0
+    while cut > summarized_count:
+        cost = estimate_tokens(turns[cut - 1]["content"])
+        if used + cost > token_budget and cut < len(turns):
+            break
+        used += cost
+        cut -= 1
+    while cut < len(turns) - 1 and turns[cut]["role"] != "user":
+        cut += 1
+    return turns[:cut], turns[cut:]
+
+# ------------------- GIỚI HẠN TỐC ĐỘ GỌI API -------------------
+GEMINI_RPM = int(os.environ.get("GEMINI_RPM", 60))
+
+class TokenBucket:
+    """Giới hạn tốc độ kiểu token bucket cho asyncio: nạp lại rate_per_minute token mỗi phút, tích tối đa capacity token."""
+
+    def __init__(self, rate_per_minute, capacity=1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Chờ tới khi có một token rồi lấy nó."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# ------------------- HÀNG ĐỢI JOB CHẠY NỀN -------------------
+AI_JOB_WORKERS = int(os.environ.get("AI_JOB_WORKERS", 4))
+AI_JOB_TIMEOUT_SECONDS = float(os.environ.get("AI_JOB_TIMEOUT_SECONDS", 120))
+AI_JOB_RETENTION_SECONDS = float(os.environ.get("AI_JOB_RETENTION_SECONDS", 900))
+AI_JOB_ACTIVE = ('queued', 'running')
+
+class AIJobQueue:
+    """
+    Hàng đợi job trong tiến trình, chạy trên một pool luồng: nút bấm chỉ nộp job rồi trả về ngay.
+    Các yêu cầu giống hệt nhau (cùng key) đang chờ/chạy được gộp vào một job dùng chung giữa các phiên;
+    job quá AI_JOB_TIMEOUT_SECONDS (tính từ lúc nộp) bị đánh dấu 'timeout' và kết quả muộn bị bỏ qua.
+    """
+
+    def __init__(self, max_workers=AI_JOB_WORKERS, timeout=AI_JOB_TIMEOUT_SECONDS, retention=AI_JOB_RETENTION_SECONDS):
+        self.timeout = timeout
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ai-job")
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+        self._jobs = {}
+        self._inflight = {}
+        self._stats = {'submitted': 0, 'deduped': 0, 'done': 0, 'error': 0, 'cancelled': 0, 'timeout': 0}
+
+    def submit(self, key, fn, *args, subscriber=None):
+        """Nộp fn(*args) và trả về job_id; nếu đã có job cùng key đang chờ/chạy thì dùng lại job đó."""
+        with self._lock:
+            self._expire_locked()
+            job_id = self._inflight.get(key)
+            if job_id is not None:
+                self._jobs[job_id]['subscribers'].add(subscriber)
+                self._stats['deduped'] += 1
+                return job_id
+
+            job_id = os.urandom(8).hex()
+            self._jobs[job_id] = {
+                'id': job_id, 'key': key, 'status': 'queued', 'subscribers': {subscriber},
+                'created': time.time(), 'started': None, 'finished': None, 'result': None, 'error': None
+            }
+            self._inflight[key] = job_id
+            self._stats['submitted'] += 1
+        self._executor.submit(self._run, job_id, fn, args)
+        return job_id
+
+    def _run(self, job_id, fn, args):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != 'queued':
+                return  # Đã bị huỷ hoặc quá hạn khi còn trong hàng đợi
+            job['status'] = 'running'
+            job['started'] = time.time()
+
+        result, error = None, None
+        try:
+            result = fn(*args)
+        except Exception as e:
+            error = e
+
+        with self._lock:
+            if job['status'] != 'running':
+                return  # Bị huỷ/quá hạn trong lúc chạy: bỏ kết quả muộn
+            self._finish_locked(job, 'done' if error is None else 'error')
+            job['result'] = result
+            job['error'] = error
+
+    def _finish_locked(self, job, status):
+        job['status'] = status
+        job['finished'] = time.time()
+        self._stats[status] += 1
+        if self._inflight.get(job['key']) == job['id']:
+            del self._inflight[job['key']]
+        self._finished.notify_all()
+
+    def _expire_locked(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job['status'] in AI_JOB_ACTIVE and now - job['created'] > self.timeout:
+                self._finish_locked(job, 'timeout')
+            elif job['finished'] is not None and now - job['finished'] > self.retention:
+                del self._jobs[job_id]
+
+    def get(self, job_id):
+        """Ảnh chụp trạng thái job (None nếu không còn giữ)."""
+        with self._lock:
+            self._expire_locked()
+            job = self._jobs.get(job_id)
+            return None if job is None else {**job, 'subscribers': len(job['subscribers'])}
+
+    def wait(self, job_id):
+        """Chờ job kết thúc (xong, lỗi, huỷ hoặc quá hạn) rồi trả về ảnh chụp như get()."""
+        with self._lock:
+            while True:
+                self._expire_locked()
+                job = self._jobs.get(job_id)
+                if job is None or job['status'] not in AI_JOB_ACTIVE:
+                    return None if job is None else {**job, 'subscribers': len(job['subscribers'])}
+                self._finished.wait(max(job['created'] + self.timeout - time.time(), 0) + 0.01)
+
+    def cancel(self, job_id, subscriber=None):
+        """Rút phiên khỏi job; job chỉ bị huỷ thật khi không còn phiên nào chờ. Trả về True nếu đã huỷ."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] not in AI_JOB_ACTIVE:
+                return False
+            job['subscribers'].discard(subscriber)
+            if job['subscribers']:
+                return False
+            self._finish_locked(job, 'cancelled')
+            return True
+
+    def stats(self):
+        with self._lock:
+            self._expire_locked()
+            counts = {status: 0 for status in AI_JOB_ACTIVE}
+            for job in self._jobs.values():
+                if job['status'] in counts:
+                    counts[job['status']] += 1
+            return {**self._stats, **counts}
@@ -1,8 +1,34 @@
+import asyncio
+import cProfile
+import hashlib
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import numpy as np
+import httpx
+import pyarrow as pa
 import streamlit as st
 import pandas as pd
 from google import genai
+from google.genai import types
 from google.genai.errors import APIError
 
+import financial_core as core
+from financial_core import (
+    AI_CACHE_MAX_BYTES, AI_CACHE_PATH, AI_CACHE_TTL_SECONDS, AI_JOB_ACTIVE, AI_JOB_TIMEOUT_SECONDS,
+    AI_PROMPT_TOKEN_BUDGET, ANALYSIS_MODEL, ANALYSIS_PROMPT_TEMPLATE, CHAT_HISTORY_TOKEN_BUDGET, GEMINI_RPM,
+    LINE_ITEM_ALIASES, TABLE_PAGE_SIZE, AIJobQueue, ResponseCache, TokenBucket,
+    build_analysis_prompt, build_batch_ai_items, build_data_for_ai, company_file_keys, compute_ratios, estimate_tokens,
+    period_columns, retrieval_context, rolling_column, run_ai_analysis, search_statement_index, split_chat_history,
+    stack_company_sheets, table_search_labels, table_view_rows
+)
+
 # --- Cấu hình Trang Streamlit ---
 st.set_page_config(
     page_title="App Phân Tích Báo Cáo Tài Chính",
@@ -11,190 +37,878 @@ st.set_page_config(
 
 st.title("Ứng dụng Phân Tích Báo Cáo Tài Chính 📊")
 
-# ------------------- [Giữ nguyên] HÀM TÍNH TOÁN -------------------
-@st.cache_data
-def process_financial_data(df):
-    """Thực hiện các phép tính Tăng trưởng và Tỷ trọng."""
-    numeric_cols = ['Năm trước', 'Năm sau']
-    for col in numeric_cols:
-        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+# ------------------- ĐO THỜI GIAN CÁC BƯỚC (TRACING) -------------------
+# Mỗi bước nóng được bọc trong một span; các span lồng nhau tạo thành một trace cho mỗi lần chạy fragment.
+# Trace đã xong được lưu trong session (hiện ở thanh bên gỡ lỗi) và, nếu cấu hình, ghi thêm ra file JSON Lines.
+TRACE_LOG_PATH = os.environ.get("TRACE_LOG_PATH", "")
+TRACE_HISTORY_SIZE = int(os.environ.get("TRACE_HISTORY_SIZE", 20))
+DEBUG_PANEL = os.environ.get("DEBUG_PANEL", "0") == "1"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(".cache", "profiles"))
+TRACE_SERVICE_NAME = "phan-tich-bao-cao-tai-chinh"
 
-    df['Tốc độ tăng trưởng (%)'] = (
-        (df['Năm sau'] - df['Năm trước']) / df['Năm trước'].replace(0, 1e-9)
-    ) * 100
+_trace_local = threading.local()
+_trace_log_lock = threading.Lock()
 
-    tong_tai_san_row = df[df['Chỉ tiêu'].str.contains('TỔNG CỘNG TÀI SẢN', case=False, na=False)]
-    if tong_tai_san_row.empty:
-        raise ValueError("Không tìm thấy chỉ tiêu 'TỔNG CỘNG TÀI SẢN'.")
+@contextmanager
+def trace_span(name, **attributes):
+    """Đo một bước: span con của span đang mở trong luồng hiện tại, hoặc span gốc của một trace mới."""
+    stack = getattr(_trace_local, "stack", None)
+    if not stack:
+        stack = _trace_local.stack = []
+        _trace_local.spans = []
+        _trace_local.trace_id = os.urandom(16).hex()
+    spans = _trace_local.spans
 
-    tong_tai_san_N_1 = tong_tai_san_row['Năm trước'].iloc[0]
-    tong_tai_san_N = tong_tai_san_row['Năm sau'].iloc[0]
+    span = {
+        "name": name,
+        "trace_id": _trace_local.trace_id,
+        "span_id": os.urandom(8).hex(),
+        "parent_span_id": stack[-1]["span_id"] if stack else None,
+        "depth": len(stack),
+        "start_time_unix_nano": time.time_ns(),
+        "duration_ms": None,
+        "status": "OK",
+        "attributes": dict(attributes),
+    }
+    started = time.perf_counter()
+    stack.append(span)
+    try:
+        yield span
+    except Exception as e:
+        span["status"] = "ERROR"
+        span["attributes"]["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if span["duration_ms"] is None:
+            # Span đo một việc đã chạy ở nơi khác (job nền) thì tự đặt start_time_unix_nano/duration_ms
+            span["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        span["end_time_unix_nano"] = span["start_time_unix_nano"] + int(span["duration_ms"] * 1e6)
+        # remove thay vì pop: span của generator có thể được đóng muộn hơn span mở sau nó
+        if span in stack:
+            stack.remove(span)
+        spans.append(span)
+        if not stack:
+            _finish_trace(spans)
 
-    # Sửa lỗi chia cho 0
-    divisor_N_1 = tong_tai_san_N_1 if tong_tai_san_N_1 != 0 else 1e-9
-    divisor_N = tong_tai_san_N if tong_tai_san_N != 0 else 1e-9
+def annotate_span(**attributes):
+    """Gắn thêm thuộc tính (kích thước prompt, cache hit…) vào span trong cùng đang mở; không có span thì bỏ qua."""
+    stack = getattr(_trace_local, "stack", None)
+    if stack:
+        stack[-1]["attributes"].update(attributes)
 
-    df['Tỷ trọng Năm trước (%)'] = (df['Năm trước'] / divisor_N_1) * 100
-    df['Tỷ trọng Năm sau (%)'] = (df['Năm sau'] / divisor_N) * 100
+def traced_stream(name, chunks, **attributes):
+    """Bọc một luồng text trong span: ghi thời gian tới đoạn đầu tiên (TTFB), số đoạn và số ký tự nhận được."""
+    with trace_span(name, **attributes) as span:
+        started = time.perf_counter()
+        n_chunks, n_chars = 0, 0
+        for chunk in chunks:
+            if n_chunks == 0:
+                span["attributes"]["ttfb_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            n_chunks += 1
+            n_chars += len(chunk)
+            yield chunk
+        span["attributes"].update(chunks=n_chunks, response_chars=n_chars)
 
-    return df
+def _finish_trace(spans):
+    """Trace đã xong: ghi log JSON Lines (nếu bật) và lưu vào lịch sử của session."""
+    spans.sort(key=lambda s: s["start_time_unix_nano"])
+    if TRACE_LOG_PATH:
+        with _trace_log_lock, open(TRACE_LOG_PATH, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span, ensure_ascii=False, default=str) + "\n")
+    history = st.session_state.setdefault("trace_history", [])
+    history.append(spans)
+    del history[:-TRACE_HISTORY_SIZE]
 
-# ------------------- [Giữ nguyên] HÀM GỌI GEMINI CHO PHÂN TÍCH TÓM TẮT -------------------
-def get_ai_analysis(data_for_ai, api_key):
-    """Gửi dữ liệu phân tích đến Gemini API và nhận nhận xét."""
-    try:
-        client = genai.Client(api_key=api_key)
-        model_name = 'gemini-2.5-flash'
-
-        prompt = f"""
-        Bạn là một chuyên gia phân tích tài chính chuyên nghiệp. Dựa trên các chỉ số tài chính sau, hãy đưa ra một nhận xét khách quan, ngắn gọn (khoảng 3-4 đoạn) về tình hình tài chính của doanh nghiệp. Đánh giá tập trung vào tốc độ tăng trưởng, thay đổi cơ cấu tài sản và khả năng thanh toán hiện hành.
-        
-        Dữ liệu thô và chỉ số:
-        {data_for_ai}
-        """
+def _otlp_value(value):
+    """Giá trị thuộc tính theo kiểu AnyValue của OTLP/JSON."""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, (int, np.integer)):
+        return {"intValue": str(int(value))}
+    if isinstance(value, (float, np.floating)):
+        return {"doubleValue": float(value)}
+    return {"stringValue": str(value)}
+
+def traces_to_otlp(traces):
+    """Chuyển các trace sang định dạng OTLP/JSON (nhập được vào Jaeger, Tempo… qua OpenTelemetry Collector)."""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": "python.py"},
+                "spans": [
+                    {
+                        "traceId": span["trace_id"],
+                        "spanId": span["span_id"],
+                        **({"parentSpanId": span["parent_span_id"]} if span["parent_span_id"] else {}),
+                        "name": span["name"],
+                        "kind": 1,
+                        "startTimeUnixNano": str(span["start_time_unix_nano"]),
+                        "endTimeUnixNano": str(span["end_time_unix_nano"]),
+                        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span["attributes"].items()],
+                        "status": {"code": 2, "message": span["attributes"].get("error", "")} if span["status"] == "ERROR" else {"code": 1},
+                    }
+                    for spans in traces for span in spans
+                ],
+            }],
+        }]
+    }
+
+def save_profile(profiler, top_n=30):
+    """Ghi kết quả cProfile ra file .prof và trả về bản tóm tắt các hàm tốn thời gian nhất (theo cumulative)."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S.prof"))
+    profiler.dump_stats(path)
+    buffer = io.StringIO()
+    pstats.Stats(profiler, stream=buffer).sort_stats("cumulative").print_stats(top_n)
+    return {"path": path, "text": buffer.getvalue()}
+
+# Profile một lần chạy toàn trang khi được yêu cầu từ thanh bên gỡ lỗi (dừng ở cuối script)
+_leftover_profiler = st.session_state.pop("active_profiler", None)
+if _leftover_profiler is not None:
+    # Lần chạy trước bị ngắt giữa chừng (rerun) nên chưa kịp dừng profiler
+    _leftover_profiler.disable()
+if st.session_state.pop("profile_next_run", False):
+    st.session_state.active_profiler = cProfile.Profile()
+    st.session_state.active_profiler.enable()
+
+# ------------------- LÕI PHÂN TÍCH (financial_core, CACHE THEO PHIÊN STREAMLIT) -------------------
+# Các phép tính nằm trong financial_core (không phụ thuộc Streamlit, dùng chung với cli.py); ở đây chỉ bọc cache
+build_line_item_index = st.cache_data(core.build_line_item_index)
+process_financial_data = st.cache_data(core.process_financial_data)
+process_financial_data_batch = st.cache_data(core.process_financial_data_batch)
+
+def file_content_hash(uploaded_file):
+    """SHA-256 nội dung file tải lên, dùng làm khoá cache cho bước đọc Excel."""
+    return hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def read_financial_workbook(content_hash, _content, all_sheets=False):
+    """
+    Đọc file Excel báo cáo tài chính, cache theo hash nội dung nên các lần rerun (kể cả mỗi tin nhắn chat)
+    không phải phân tích lại workbook. all_sheets=True trả về dict tên sheet -> DataFrame, bỏ qua sheet không đủ cột Chỉ tiêu và hai kỳ số liệu.
+    """
+    return core.read_financial_workbook(_content, all_sheets=all_sheets)
+
+def load_batch_workbooks(uploaded_files):
+    """Đọc nhiều file Excel (hoặc nhiều sheet trong một file) và xếp chồng thành một bảng dài theo 'Công ty'."""
+    return stack_company_sheets(
+        (ten, read_financial_workbook(file_content_hash(f), f.getvalue(), all_sheets=True))
+        for ten, f in zip(company_file_keys([f.name for f in uploaded_files]), uploaded_files)
+    )
+
+# ------------------- HIỂN THỊ BẢNG LỚN (LỌC, TOP N, PHÂN TRANG PHÍA SERVER) -------------------
+def processed_column_config(df):
+    """Định dạng số qua column_config (trình duyệt tự định dạng) thay vì dựng pandas Styler trên cả bảng."""
+    tien = st.column_config.NumberColumn(format="%,.0f")
+    phan_tram = st.column_config.NumberColumn(format="%.2f%%")
+    periods = period_columns(df)
+    config = {col: phan_tram for col in df.columns if col.endswith('(%)')}
+    config.update({col: tien for col in periods})
+    config.update({rolling_column(p): tien for p in periods if rolling_column(p) in df.columns})
+    return config
+
+TABLE_VIEWS = {
+    'all': "Toàn bảng",
+    'weight': "Top N theo tỷ trọng",
+    'growth': "Top N theo tốc độ tăng trưởng",
+}
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _table_search_labels(table_key, _df):
+    """Nhãn lọc bảng (table_search_labels), cache theo table_key."""
+    return table_search_labels(_df)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def table_view_page(table_key, _df, query='', view='all', top_n=None, page=1, page_size=TABLE_PAGE_SIZE):
+    """
+    Một trang của bảng (table_view_rows: lọc, top N, cắt trang) dưới dạng Arrow Table, cache theo table_key và
+    tham số xem. Trả về (trang, số dòng khớp).
+    """
+    nhan = _table_search_labels(table_key, _df) if query else None
+    trang, so_dong = table_view_rows(_df, query, view, top_n, page, page_size, search_labels=nhan)
+    return pa.Table.from_pandas(trang), so_dong
 
-        response = client.models.generate_content(
-            model=model_name,
-            contents=prompt
+def render_large_table(df, table_key, column_config=None, key="bang"):
+    """
+    Hiển thị bảng lớn: lọc, top N và phân trang chạy phía server, trình duyệt chỉ nhận một trang đã chuyển sẵn
+    sang Arrow nên thời gian hiển thị không tăng theo kích thước báo cáo.
+    """
+    col_loc, col_xem, col_n, col_trang = st.columns([3, 2, 1, 1])
+    with col_loc:
+        query = st.text_input("Lọc chỉ tiêu", key=f"{key}_query", placeholder="vd: hàng tồn kho, nợ ngắn hạn")
+    with col_xem:
+        view = st.selectbox("Hiển thị", options=list(TABLE_VIEWS), format_func=TABLE_VIEWS.get, key=f"{key}_view")
+    top_n = None
+    if view != 'all':
+        with col_n:
+            top_n = st.number_input("N", min_value=1, max_value=max(len(df), 1), value=min(20, max(len(df), 1)), key=f"{key}_top_n")
+
+    page = st.session_state.get(f"{key}_page", 1)
+    trang, so_dong = table_view_page(table_key, df, query, view, top_n, page, TABLE_PAGE_SIZE)
+    so_trang = max(1, -(-so_dong // TABLE_PAGE_SIZE))
+    if page > so_trang:
+        # Bộ lọc mới làm số trang giảm: quay về trang cuối còn dữ liệu
+        page = st.session_state[f"{key}_page"] = so_trang
+        trang, so_dong = table_view_page(table_key, df, query, view, top_n, page, TABLE_PAGE_SIZE)
+    if so_trang > 1:
+        with col_trang:
+            st.number_input(f"Trang (/{so_trang})", min_value=1, max_value=so_trang, step=1, key=f"{key}_page")
+
+    st.dataframe(trang, column_config=column_config, use_container_width=True)
+    dau = (page - 1) * TABLE_PAGE_SIZE
+    st.caption(
+        f"Dòng {min(dau + 1, so_dong):,}–{min(dau + TABLE_PAGE_SIZE, so_dong):,} / {so_dong:,} dòng khớp"
+        + (f" (tổng {len(df):,} dòng)" if so_dong != len(df) else "")
+    )
+
+# ------------------- CHỈ MỤC TRUY XUẤT CỤC BỘ CHO CHAT (TF-IDF, KHÔNG CẦN MẠNG) -------------------
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_statement_index(table_key, _df_processed, _df_ratios=None):
+    """Chỉ mục truy xuất cho chat (core.build_statement_index), dựng một lần cho mỗi file (cache theo table_key)."""
+    return core.build_statement_index(_df_processed, _df_ratios)
+
+# ------------------- CLIENT GEMINI DÙNG CHUNG (CONNECTION POOL + RETRY) -------------------
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 8))
+GEMINI_POOL_SIZE = int(os.environ.get("GEMINI_POOL_SIZE", 16))
+GEMINI_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_TIMEOUT_SECONDS", 120))
+# Chính sách retry: lùi theo hàm mũ có jitter với các mã 429/5xx
+GEMINI_RETRY_ATTEMPTS = int(os.environ.get("GEMINI_RETRY_ATTEMPTS", 5))
+GEMINI_RETRY_INITIAL_DELAY = float(os.environ.get("GEMINI_RETRY_INITIAL_DELAY", 1.0))
+GEMINI_RETRY_MAX_DELAY = float(os.environ.get("GEMINI_RETRY_MAX_DELAY", 30.0))
+GEMINI_RETRY_EXP_BASE = float(os.environ.get("GEMINI_RETRY_EXP_BASE", 2.0))
+GEMINI_RETRY_JITTER = float(os.environ.get("GEMINI_RETRY_JITTER", 1.0))
+GEMINI_RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+class SharedGeminiClient:
+    """
+    Một genai.Client cho cả tiến trình: giữ kết nối HTTP keep-alive trong pool, retry 429/5xx
+    bằng cơ chế lùi hàm mũ + jitter của SDK và giới hạn số lời gọi đồng thời giữa các phiên.
+    """
+
+    def __init__(self, api_key, max_concurrency=GEMINI_MAX_CONCURRENCY, pool_size=GEMINI_POOL_SIZE,
+                 retry_options=None, timeout=GEMINI_TIMEOUT_SECONDS):
+        self.max_concurrency = max_concurrency
+        self._api_key = api_key
+        self._pool_size = pool_size
+        # SDK gửi timeout của HttpOptions cho từng request (None = tắt timeout của httpx), nên phải đặt ở đây
+        self._timeout_ms = int(timeout * 1000)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'in_flight': 0, 'waiting': 0, 'http_requests': 0, 'retryable_responses': 0}
+        self.retry_options = retry_options or types.HttpRetryOptions(
+            attempts=GEMINI_RETRY_ATTEMPTS,
+            initial_delay=GEMINI_RETRY_INITIAL_DELAY,
+            max_delay=GEMINI_RETRY_MAX_DELAY,
+            exp_base=GEMINI_RETRY_EXP_BASE,
+            jitter=GEMINI_RETRY_JITTER,
+            http_status_codes=GEMINI_RETRY_STATUS_CODES
+        )
+        self._http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=60),
+            event_hooks={'request': [self._on_request], 'response': [self._on_response]}
         )
-        return response.text
+        self._client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(
+                timeout=self._timeout_ms, retry_options=self.retry_options, httpx_client=self._http_client
+            )
+        )
+
+    def _count(self, name, delta=1):
+        with self._lock:
+            self._stats[name] += delta
+
+    def _on_request(self, request):
+        self._count('http_requests')
+
+    def _on_response(self, response):
+        if response.status_code in (self.retry_options.http_status_codes or ()):
+            self._count('retryable_responses')
+
+    def _acquire(self):
+        self._count('waiting')
+        self._semaphore.acquire()
+        self._count('waiting', -1)
+        self._count('in_flight')
+        self._count('calls')
+
+    def _release(self):
+        self._count('in_flight', -1)
+        self._semaphore.release()
+
+    def generate_content(self, **kwargs):
+        """Như client.models.generate_content, trong giới hạn đồng thời."""
+        self._acquire()
+        try:
+            return self._client.models.generate_content(**kwargs)
+        finally:
+            self._release()
+
+    def generate_content_stream(self, **kwargs):
+        """Như client.models.generate_content_stream; giữ một suất đồng thời cho tới khi luồng kết thúc."""
+        self._acquire()
+        try:
+            yield from self._client.models.generate_content_stream(**kwargs)
+        finally:
+            self._release()
 
-    except APIError as e:
+    async def _aon_request(self, request):
+        self._on_request(request)
+
+    async def _aon_response(self, response):
+        self._on_response(response)
+
+    def async_client(self):
+        """
+        genai AsyncClient (dùng với `async with`) cho một lượt chạy asyncio, cùng khoá API. Pool HTTP async riêng vì
+        kết nối async gắn với vòng lặp sự kiện đang chạy (đóng khi thoát `async with`); phần sync dùng lại pool chung
+        nên không mở thêm pool nào bị bỏ quên. SDK không tự retry (attempts=1): người gọi retry trong vòng lặp của
+        mình để mọi lần gửi đều qua bộ giới hạn tốc độ.
+        """
+        client = genai.Client(
+            api_key=self._api_key,
+            http_options=types.HttpOptions(
+                timeout=self._timeout_ms,
+                retry_options=types.HttpRetryOptions(attempts=1),
+                httpx_client=self._http_client,
+                async_client_args={
+                    'limits': httpx.Limits(max_connections=self._pool_size, max_keepalive_connections=self._pool_size),
+                    'event_hooks': {'request': [self._aon_request], 'response': [self._aon_response]},
+                }
+            )
+        )
+        return client.aio
+
+    @asynccontextmanager
+    async def async_slot(self):
+        """Giữ một suất trong giới hạn đồng thời chung của tiến trình cho lời gọi async, chờ mà không chặn vòng lặp sự kiện."""
+        self._count('waiting')
+        try:
+            while not self._semaphore.acquire(blocking=False):
+                await asyncio.sleep(0.05)
+        finally:
+            self._count('waiting', -1)
+        self._count('in_flight')
+        self._count('calls')
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self):
+        """Thống kê lời gọi, retry và trạng thái connection pool."""
+        with self._lock:
+            stats = dict(self._stats)
+        pool = getattr(getattr(self._http_client, '_transport', None), '_pool', None)
+        connections = list(getattr(pool, 'connections', []))
+        stats['max_concurrency'] = self.max_concurrency
+        stats['pool_connections'] = len(connections)
+        stats['pool_idle'] = sum(1 for c in connections if getattr(c, 'is_idle', lambda: False)())
+        return stats
+
+@st.cache_resource
+def get_gemini_client(api_key):
+    """Client Gemini dùng chung cho mọi phiên (mỗi khoá API một client)."""
+    return SharedGeminiClient(api_key)
+
+def render_client_stats(api_key):
+    """Hiển thị thống kê pool kết nối và retry của client Gemini dùng chung."""
+    stats = get_gemini_client(api_key).stats()
+    st.caption(
+        f"🔌 Client Gemini: {stats['calls']} lời gọi · {stats['in_flight']}/{stats['max_concurrency']} đang chạy, "
+        f"{stats['waiting']} đang chờ · {stats['http_requests']} HTTP request, {stats['retryable_responses']} phản hồi 429/5xx được retry · "
+        f"pool {stats['pool_connections']} kết nối ({stats['pool_idle']} rảnh)"
+    )
+
+# ------------------- HÀM GỌI GEMINI CHO PHÂN TÍCH TÓM TẮT -------------------
+def _ai_error_message(e):
+    """Thông báo lỗi thân thiện cho người dùng khi gọi Gemini thất bại."""
+    if isinstance(e, APIError):
         return f"Lỗi gọi Gemini API: Vui lòng kiểm tra Khóa API hoặc giới hạn sử dụng. Chi tiết lỗi: {e}"
-    except KeyError:
+    if isinstance(e, KeyError):
         return "Lỗi: Không tìm thấy Khóa API 'GEMINI_API_KEY'. Vui lòng kiểm tra cấu hình Secrets trên Streamlit Cloud."
-    except Exception as e:
-        return f"Đã xảy ra lỗi không xác định: {e}"
+    return f"Đã xảy ra lỗi không xác định: {e}"
 
-# ------------------- [Giữ nguyên] CHỨC NĂNG 1-5 -------------------
-uploaded_file = st.file_uploader(
-    "1. Tải file Excel Báo cáo Tài chính (Chỉ tiêu | Năm trước | Năm sau)",
-    type=['xlsx', 'xls']
-)
+def _iter_stream_text(stream):
+    """Lấy phần text của từng chunk trong luồng trả về từ generate_content_stream."""
+    for chunk in stream:
+        text = getattr(chunk, "text", None)
+        if text:
+            yield text
 
-if uploaded_file is not None:
-    try:
-        df_raw = pd.read_excel(uploaded_file)
-        df_raw.columns = ['Chỉ tiêu', 'Năm trước', 'Năm sau']
-
-        df_processed = process_financial_data(df_raw.copy())
-
-        if df_processed is not None:
-            st.subheader("2. Tốc độ Tăng trưởng & 3. Tỷ trọng Cơ cấu Tài sản")
-            st.dataframe(
-                df_processed.style.format({
-                    'Năm trước': '{:,.0f}',
-                    'Năm sau': '{:,.0f}',
-                    'Tốc độ tăng trưởng (%)': '{:.2f}%',
-                    'Tỷ trọng Năm trước (%)': '{:.2f}%',
-                    'Tỷ trọng Năm sau (%)': '{:.2f}%'
-                }),
-                use_container_width=True
-            )
+def stream_with_cache(cache, cache_key, open_stream):
+    """Trả về ngay câu trả lời đã lưu nếu có; nếu không thì stream từ open_stream() và lưu khi luồng kết thúc trọn vẹn."""
+    cached = cache.get(cache_key)
+    annotate_span(cache_hit=cached is not None)
+    if cached is not None:
+        yield cached
+        return
+
+    parts = []
+    for text in _iter_stream_text(open_stream()):
+        parts.append(text)
+        yield text
+    if parts:
+        cache.set(cache_key, ''.join(parts))
+
+# ------------------- BỘ NHỚ ĐỆM PHẢN HỒI AI -------------------
+@st.cache_resource
+def get_response_cache():
+    """Một bộ nhớ đệm dùng chung cho mọi phiên trong tiến trình."""
+    return ResponseCache(AI_CACHE_PATH, AI_CACHE_TTL_SECONDS, AI_CACHE_MAX_BYTES)
+
+def render_cache_stats():
+    """Hiển thị chỉ số trúng/trượt của bộ nhớ đệm phản hồi AI."""
+    stats = get_response_cache().stats()
+    st.caption(
+        f"🗄️ Bộ nhớ đệm AI: {stats['hits']} trúng / {stats['misses']} trượt "
+        f"(tỷ lệ trúng {stats['hit_rate']:.0%}) · {stats['entries']} mục · {stats['bytes'] / 1024:,.1f} KB"
+    )
+
+# ------------------- PHÂN TÍCH AI HÀNG LOẠT (BẤT ĐỒNG BỘ) -------------------
+BATCH_AI_CONCURRENCY = int(os.environ.get("BATCH_AI_CONCURRENCY", 8))
+BATCH_AI_ATTEMPTS = int(os.environ.get("BATCH_AI_ATTEMPTS", 3))
 
-            st.subheader("4. Các Chỉ số Tài chính Cơ bản")
+async def analyze_many_async(items, api_key, rpm=GEMINI_RPM, max_concurrency=BATCH_AI_CONCURRENCY, attempts=BATCH_AI_ATTEMPTS):
+    """
+    Phân tích đồng thời nhiều bảng bằng client async của SDK, trong giới hạn token bucket theo quota (rpm)
+    và số lời gọi đồng thời (của lượt này và giới hạn chung của tiến trình). Trả về (async generator) kết quả
+    từng công ty ngay khi xong; lỗi của một mục được thử lại và không ảnh hưởng các mục khác.
+    """
+    bucket = TokenBucket(rpm)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    cache = get_response_cache()
+    shared = get_gemini_client(api_key)
+
+    async with shared.async_client() as aclient:
+        async def analyze_one(cong_ty, data_for_ai):
+            started = time.perf_counter()
+            result = {'Công ty': cong_ty, 'Trạng thái': '✅', 'Số lần thử': 0, 'Thời gian (s)': 0.0, 'Nhận xét': ''}
+            cache_key = cache.make_key(ANALYSIS_MODEL, ANALYSIS_PROMPT_TEMPLATE, data_for_ai)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                result.update({'Trạng thái': '✅ (bộ nhớ đệm)', 'Nhận xét': cached})
+                return result
+
+            for attempt in range(1, attempts + 1):
+                result['Số lần thử'] = attempt
+                try:
+                    # Mỗi lần thử đều lấy token của bucket và một suất đồng thời chung với các phiên khác
+                    async with semaphore:
+                        await bucket.acquire()
+                        async with shared.async_slot():
+                            response = await aclient.models.generate_content(
+                                model=ANALYSIS_MODEL,
+                                contents=build_analysis_prompt(data_for_ai)
+                            )
+                    if not response.text:
+                        raise ValueError("Mô hình không trả về nội dung.")
+                    cache.set(cache_key, response.text)
+                    result['Nhận xét'] = response.text
+                    break
+                except Exception as e:
+                    if attempt == attempts:
+                        result.update({'Trạng thái': '❌', 'Nhận xét': _ai_error_message(e)})
+                        break
+                    # Lùi theo hàm mũ có jitter trước khi thử lại mục này
+                    delay = min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_INITIAL_DELAY * GEMINI_RETRY_EXP_BASE ** (attempt - 1))
+                    await asyncio.sleep(delay + random.uniform(0, GEMINI_RETRY_JITTER))
+
+            result['Thời gian (s)'] = round(time.perf_counter() - started, 2)
+            return result
+
+        for next_result in asyncio.as_completed([analyze_one(cong_ty, data) for cong_ty, data in items]):
+            yield await next_result
+
+def run_batch_ai_analysis(items, api_key, on_result=None, **kwargs):
+    """Chạy analyze_many_async trong một vòng lặp sự kiện riêng; gọi on_result(kết quả, tất cả kết quả) mỗi khi một mục xong."""
+    async def collect():
+        results = []
+        async for result in analyze_many_async(items, api_key, **kwargs):
+            results.append(result)
+            if on_result is not None:
+                on_result(result, results)
+        return results
+
+    return asyncio.run(collect())
+
+# ------------------- HÀNG ĐỢI JOB PHÂN TÍCH AI (CHẠY NỀN) -------------------
+AI_JOB_POLL_SECONDS = float(os.environ.get("AI_JOB_POLL_SECONDS", 1.5))
+
+@st.cache_resource
+def get_ai_job_queue():
+    """Một hàng đợi job dùng chung cho mọi phiên trong tiến trình."""
+    return AIJobQueue()
+
+def _session_token():
+    """Định danh ngẫu nhiên của phiên hiện tại (dùng làm subscriber của job)."""
+    return st.session_state.setdefault("session_token", os.urandom(8).hex())
+
+def job_http_options(remaining_seconds):
+    """
+    Tuỳ chọn HTTP cho một lần gọi Gemini trong job: timeout là toàn bộ thời gian còn lại của job (chặn trên bởi
+    GEMINI_TIMEOUT_SECONDS), SDK không tự retry để lời gọi đã hết giờ không bị gửi lại (và tính phí) nhiều lần.
+    """
+    return types.HttpOptions(
+        timeout=max(int(min(GEMINI_TIMEOUT_SECONDS, remaining_seconds) * 1000), 1000),
+        retry_options=types.HttpRetryOptions(attempts=1)
+    )
+
+def _retryable_job_error(e):
+    """Lỗi hỏng nhanh đáng thử lại trong job (429/5xx, không kết nối được); hết giờ thì không thử lại."""
+    if isinstance(e, APIError):
+        return e.code in GEMINI_RETRY_STATUS_CODES
+    return isinstance(e, httpx.ConnectError)
+
+def _run_analysis_job(client, cache, cache_key, prompt, deadline):
+    """
+    Thân job phân tích (chạy trong luồng nền): run_ai_analysis, lần gọi đầu được dùng hết thời gian còn lại tới
+    deadline; chỉ lỗi hỏng nhanh mới được thử lại (lùi hàm mũ + jitter) và chỉ khi còn thời gian.
+    """
+    for attempt in range(1, max(GEMINI_RETRY_ATTEMPTS, 1) + 1):
+        config = types.GenerateContentConfig(http_options=job_http_options(deadline - time.time()))
+        try:
+            return run_ai_analysis(client, cache, cache_key, prompt, config=config)
+        except Exception as e:
+            delay = min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_INITIAL_DELAY * GEMINI_RETRY_EXP_BASE ** (attempt - 1))
+            delay += random.uniform(0, GEMINI_RETRY_JITTER)
+            if attempt == GEMINI_RETRY_ATTEMPTS or not _retryable_job_error(e) or time.time() + delay + 1 >= deadline:
+                raise
+            time.sleep(delay)
+
+def submit_ai_analysis(data_for_ai, api_key, subscriber=None):
+    """
+    Đưa yêu cầu phân tích vào hàng đợi nền và trả về ngay {'id', 'key', kích thước prompt}; subscriber mặc định là
+    phiên hiện tại.
+    """
+    cache = get_response_cache()
+    queue = get_ai_job_queue()
+    key = cache.make_key(ANALYSIS_MODEL, ANALYSIS_PROMPT_TEMPLATE, data_for_ai)
+    prompt = build_analysis_prompt(data_for_ai)
+    job_id = queue.submit(
+        key, _run_analysis_job, get_gemini_client(api_key), cache, key, prompt,
+        time.time() + queue.timeout,
+        subscriber=subscriber if subscriber is not None else _session_token()
+    )
+    return {'id': job_id, 'key': key, 'prompt_chars': len(prompt), 'prompt_tokens_est': estimate_tokens(prompt)}
+
+def render_ai_job(job_ref):
+    """Hiển thị trạng thái/kết quả job phân tích; khi job còn chạy thì được gọi lại định kỳ (fragment run_every)."""
+    queue = get_ai_job_queue()
+    job = queue.get(job_ref['id'])
+    if job is None:
+        st.session_state.pop("ai_job", None)
+        st.info("Job phân tích đã hết hạn lưu, vui lòng yêu cầu lại.")
+        return
+
+    if job['status'] in AI_JOB_ACTIVE:
+        dem_giay = time.time() - job['created']
+        trang_thai = "⏳ Đang chờ trong hàng đợi" if job['status'] == 'queued' else "🤖 Gemini đang phân tích"
+        col_status, col_cancel = st.columns([4, 1])
+        col_status.info(f"{trang_thai}… {dem_giay:.0f}s (job `{job['id']}`, {job['subscribers']} phiên đang chờ)")
+        if col_cancel.button("Huỷ", key="ai_job_cancel"):
+            queue.cancel(job['id'], _session_token())
+            st.session_state.pop("ai_job", None)
+            st.rerun(scope="app")
+        job_ref['polling'] = True
+        return
+
+    if job_ref.pop('polling', False):
+        # Job vừa kết thúc trong lúc fragment đang hỏi định kỳ: chạy lại cả trang để dừng run_every
+        st.rerun(scope="app")
+
+    if not job_ref.get('traced'):
+        job_ref['traced'] = True
+        with trace_span("gemini.analysis_job", model=ANALYSIS_MODEL, job_id=job['id'], status=job['status'],
+                        subscribers=job['subscribers'], prompt_chars=job_ref.get('prompt_chars'),
+                        prompt_tokens_est=job_ref.get('prompt_tokens_est'),
+                        queue_ms=round(((job['started'] or job['finished']) - job['created']) * 1000, 3)) as span:
+            # Thời gian của span là lúc job thật sự chạy trong luồng nền (lời gọi Gemini), không phải lúc hiển thị
+            bat_dau = job['started'] or job['finished']
+            span["start_time_unix_nano"] = int(bat_dau * 1e9)
+            span["duration_ms"] = round((job['finished'] - bat_dau) * 1000, 3)
+            if job['status'] == 'done':
+                text, cache_hit = job['result']
+                annotate_span(cache_hit=cache_hit, response_chars=len(text or ""))
+            else:
+                span["status"] = "ERROR"
+
+    if job['status'] == 'done':
+        st.markdown("**Kết quả Phân tích từ Gemini AI:**")
+        with st.container(border=True):
+            st.markdown(job['result'][0])
+        render_cache_stats()
+    elif job['status'] == 'error':
+        st.error(_ai_error_message(job['error']))
+    elif job['status'] == 'timeout':
+        st.warning(f"Job phân tích vượt quá {AI_JOB_TIMEOUT_SECONDS:.0f}s và đã bị dừng, vui lòng thử lại.")
+    elif job['status'] == 'cancelled':
+        st.info("Job phân tích đã bị huỷ.")
+
+def render_job_stats():
+    """Hiển thị số job phân tích AI đang chờ/chạy/đã gộp trong tiến trình."""
+    stats = get_ai_job_queue().stats()
+    st.caption(
+        f"🧵 Hàng đợi AI: {stats['queued']} chờ · {stats['running']} chạy · {stats['submitted']} đã nộp "
+        f"({stats['deduped']} yêu cầu trùng được gộp) · {stats['timeout']} quá hạn · {stats['cancelled']} huỷ"
+    )
+
+# ------------------- GIAO DIỆN PHÂN TÍCH (FRAGMENT ĐỘC LẬP VỚI CHAT) -------------------
+@st.fragment
+@trace_span("ui.analysis")
+def render_analysis_section():
+    """
+    Phần phân tích báo cáo (tải file, bảng, chỉ số, nhận xét AI) chạy như một fragment:
+    thao tác trong phần này chỉ chạy lại phần này, và tin nhắn chat không chạy lại phần này.
+    """
+    # ------------------- CHẾ ĐỘ HÀNG LOẠT (NHIỀU CÔNG TY) -------------------
+    che_do_phan_tich = st.radio(
+        "Chế độ phân tích",
+        options=["Một báo cáo", "Nhiều công ty (hàng loạt)"],
+        horizontal=True,
+        key="analysis_mode"
+    )
+
+    uploaded_file = None
+    if che_do_phan_tich == "Nhiều công ty (hàng loạt)":
+        batch_files = st.file_uploader(
+            "1. Tải thư mục Báo cáo Tài chính (mỗi file hoặc mỗi sheet là một công ty: Chỉ tiêu | Năm trước | Năm sau, hoặc nhiều kỳ cũ → mới)",
+            type=['xlsx', 'xls'],
+            accept_multiple_files="directory"
+        )
+        if batch_files:
             try:
-                tsnh_n = df_processed[df_processed['Chỉ tiêu'].str.contains('TÀI SẢN NGẮN HẠN', case=False, na=False)]['Năm sau'].iloc[0]
-                tsnh_n_1 = df_processed[df_processed['Chỉ tiêu'].str.contains('TÀI SẢN NGẮN HẠN', case=False, na=False)]['Năm trước'].iloc[0]
+                with trace_span("batch.read_excel", files=len(batch_files)):
+                    df_long = load_batch_workbooks(batch_files)
+                with trace_span("batch.process_financial_data", rows=len(df_long)):
+                    df_batch, df_batch_ratios = process_financial_data_batch(df_long)
 
-                no_ngan_han_N = df_processed[df_processed['Chỉ tiêu'].str.contains('NỢ NGẮN HẠN', case=False, na=False)]['Năm sau'].iloc[0]
-                no_ngan_han_N_1 = df_processed[df_processed['Chỉ tiêu'].str.contains('NỢ NGẮN HẠN', case=False, na=False)]['Năm trước'].iloc[0]
+                # Khoá gồm cả tên công ty (lấy từ đường dẫn file) lẫn nội dung: cùng nội dung tải lên dưới tên khác
+                # thì bảng, trang đã cache và chỉ mục chat phải hiện tên mới
+                batch_key = "batch:" + hashlib.sha256(json.dumps([
+                    [ten, file_content_hash(f)]
+                    for ten, f in zip(company_file_keys([f.name for f in batch_files]), batch_files)
+                ]).encode()).hexdigest()
+                with trace_span("batch.build_statement_index", rows=len(df_batch)):
+                    # Chỉ mục truy xuất cho khung chat, dựng một lần cho bộ file này
+                    st.session_state.statement_index = {
+                        "source": f"{df_batch['Công ty'].nunique()} công ty",
+                        "index": build_statement_index(batch_key, df_batch, df_batch_ratios),
+                    }
 
-                thanh_toan_hien_hanh_N = tsnh_n / no_ngan_han_N
-                thanh_toan_hien_hanh_N_1 = tsnh_n_1 / no_ngan_han_N_1
+                with trace_span("render.batch_tables", rows=len(df_batch)):
+                    st.subheader(f"Bảng tổng hợp {df_batch['Công ty'].nunique()} công ty")
+                    render_large_table(
+                        df_batch,
+                        batch_key,
+                        column_config=processed_column_config(df_batch),
+                        key="bang_tong_hop"
+                    )
 
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.metric(
-                        label="Chỉ số Thanh toán Hiện hành (Năm trước)",
-                        value=f"{thanh_toan_hien_hanh_N_1:.2f} lần"
+                    st.subheader("Các Chỉ số Tài chính theo công ty")
+                    st.dataframe(
+                        df_batch_ratios.style.format(
+                            {col: '{:.2f}' for col in df_batch_ratios.columns if col != 'Công ty'},
+                            na_rep="N/A"
+                        ),
+                        use_container_width=True
                     )
-                with col2:
-                    st.metric(
-                        label="Chỉ số Thanh toán Hiện hành (Năm sau)",
-                        value=f"{thanh_toan_hien_hanh_N:.2f} lần",
-                        delta=f"{thanh_toan_hien_hanh_N - thanh_toan_hien_hanh_N_1:.2f}"
+
+                st.download_button(
+                    "⬇️ Tải bảng tổng hợp (CSV)",
+                    data=df_batch.merge(df_batch_ratios, on='Công ty', how='left').to_csv(index=False).encode('utf-8-sig'),
+                    file_name="bao_cao_tong_hop.csv",
+                    mime="text/csv"
+                )
+
+                st.subheader("Nhận xét AI cho từng công ty")
+                st.caption(
+                    f"Các yêu cầu chạy đồng thời (tối đa {BATCH_AI_CONCURRENCY}) trong giới hạn {GEMINI_RPM} yêu cầu/phút; "
+                    "kết quả hiện ngay khi từng công ty xong."
+                )
+                if st.button("Yêu cầu AI Phân tích tất cả công ty"):
+                    api_key = st.secrets.get("GEMINI_API_KEY")
+                    if api_key:
+                        batch_items = build_batch_ai_items(df_batch, df_batch_ratios)
+                        progress = st.progress(0.0, text="Đang gửi dữ liệu cho Gemini…")
+                        results_table = st.empty()
+
+                        def _show_batch_result(result, results):
+                            progress.progress(
+                                len(results) / len(batch_items),
+                                text=f"Đã xong {len(results)}/{len(batch_items)} công ty"
+                            )
+                            results_table.dataframe(pd.DataFrame(results), use_container_width=True, hide_index=True)
+
+                        with trace_span("gemini.batch_analysis", companies=len(batch_items),
+                                        prompt_chars=sum(len(data) for _, data in batch_items)):
+                            batch_results = run_batch_ai_analysis(batch_items, api_key, on_result=_show_batch_result)
+                        st.download_button(
+                            "⬇️ Tải nhận xét AI (CSV)",
+                            data=pd.DataFrame(batch_results).to_csv(index=False).encode('utf-8-sig'),
+                            file_name="nhan_xet_ai.csv",
+                            mime="text/csv"
+                        )
+                    else:
+                        st.error("Lỗi: Không tìm thấy Khóa API. Vui lòng cấu hình Khóa 'GEMINI_API_KEY' trong Streamlit Secrets.")
+
+            except ValueError as ve:
+                st.error(f"Lỗi cấu trúc dữ liệu: {ve}")
+            except Exception as e:
+                st.error(f"Có lỗi xảy ra khi đọc hoặc xử lý các file: {e}. Vui lòng kiểm tra định dạng file.")
+        else:
+            st.session_state.pop("statement_index", None)
+            st.info("Vui lòng tải lên thư mục chứa các file Excel để phân tích hàng loạt.")
+
+    # ------------------- CHỨC NĂNG 1-5 (MỘT BÁO CÁO) -------------------
+    else:
+        uploaded_file = st.file_uploader(
+            "1. Tải file Excel Báo cáo Tài chính (Chỉ tiêu | Năm trước | Năm sau, hoặc nhiều kỳ cũ → mới)",
+            type=['xlsx', 'xls']
+        )
+
+    if uploaded_file is not None:
+        try:
+            # Đọc cột Chỉ tiêu và mọi cột kỳ, cache theo hash nội dung file
+            content_hash = file_content_hash(uploaded_file)
+            with trace_span("upload.read_excel", bytes=uploaded_file.size):
+                df_raw = read_financial_workbook(content_hash, uploaded_file.getvalue())
+
+            with trace_span("upload.process_financial_data", rows=len(df_raw)):
+                df_processed = process_financial_data(df_raw.copy())
+
+            if df_processed is not None:
+                st.subheader("2. Tốc độ Tăng trưởng & 3. Tỷ trọng Cơ cấu Tài sản")
+                with trace_span("render.processed_table", rows=len(df_processed)):
+                    render_large_table(
+                        df_processed,
+                        "single:" + content_hash,
+                        column_config=processed_column_config(df_processed),
+                        key="bang_phan_tich"
                     )
 
-            except IndexError:
-                st.warning("Thiếu chỉ tiêu 'TÀI SẢN NGẮN HẠN' hoặc 'NỢ NGẮN HẠN' để tính chỉ số.")
-                thanh_toan_hien_hanh_N = "N/A"
-                thanh_toan_hien_hanh_N_1 = "N/A"
-
-            st.subheader("5. Nhận xét Tình hình Tài chính (AI)")
-            
-            # Xử lý để tránh lỗi nếu không tìm thấy chỉ tiêu
-            tsnh_growth = "N/A"
-            tsnh_row = df_processed[df_processed['Chỉ tiêu'].str.contains('TÀI SẢN NGẮN HẠN', case=False, na=False)]
-            if not tsnh_row.empty:
-                tsnh_growth = f"{tsnh_row['Tốc độ tăng trưởng (%)'].iloc[0]:.2f}%"
-            
-            data_for_ai = pd.DataFrame({
-                'Chỉ tiêu': [
-                    'Toàn bộ Bảng phân tích (dữ liệu thô)', 
-                    'Tăng trưởng Tài sản ngắn hạn (%)', 
-                    'Thanh toán hiện hành (N-1)', 
-                    'Thanh toán hiện hành (N)'
-                ],
-                'Giá trị': [
-                    df_processed.to_markdown(index=False),
-                    tsnh_growth, 
-                    f"{thanh_toan_hien_hanh_N_1}", 
-                    f"{thanh_toan_hien_hanh_N}"
-                ]
-            }).to_markdown(index=False)
-
-            if st.button("Yêu cầu AI Phân tích"):
-                api_key = st.secrets.get("GEMINI_API_KEY")
-                if api_key:
-                    with st.spinner('Đang gửi dữ liệu và chờ Gemini phân tích...'):
-                        ai_result = get_ai_analysis(data_for_ai, api_key)
-                        st.markdown("**Kết quả Phân tích từ Gemini AI:**")
-                        st.info(ai_result)
+                st.subheader("4. Các Chỉ số Tài chính Cơ bản")
+                with trace_span("upload.compute_ratios", rows=len(df_processed)):
+                    # Chỉ mục chỉ tiêu dựng một lần cho file (được cache), mọi tra cứu đều đi qua đây
+                    line_items = build_line_item_index(df_processed['Chỉ tiêu'])
+                    periods = period_columns(df_processed)
+                    df_ratios = compute_ratios(
+                        df_processed,
+                        {key: [line_items['items'].get(key, np.nan)] for key in LINE_ITEM_ALIASES},
+                        entities=[''],
+                        numeric_cols=periods
+                    ).drop(columns=['Công ty']).set_index('Mã chỉ số')
+
+                with trace_span("upload.build_statement_index", rows=len(df_processed)):
+                    # Chỉ mục truy xuất cho khung chat, dựng một lần cho mỗi file
+                    st.session_state.statement_index = {
+                        "source": uploaded_file.name,
+                        "index": build_statement_index("single:" + content_hash, df_processed, df_ratios),
+                    }
+
+                # Chỉ số thanh toán của hai kỳ gần nhất
+                ky_truoc, ky_sau = periods[-2:]
+                thanh_toan = df_ratios.loc['thanh_toan_hien_hanh']
+                if thanh_toan[[ky_truoc, ky_sau]].notna().all():
+                    thanh_toan_hien_hanh_N = thanh_toan[ky_sau]
+                    thanh_toan_hien_hanh_N_1 = thanh_toan[ky_truoc]
+
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.metric(
+                            label=f"Chỉ số Thanh toán Hiện hành ({ky_truoc})",
+                            value=f"{thanh_toan_hien_hanh_N_1:.2f} lần"
+                        )
+                    with col2:
+                        st.metric(
+                            label=f"Chỉ số Thanh toán Hiện hành ({ky_sau})",
+                            value=f"{thanh_toan_hien_hanh_N:.2f} lần",
+                            delta=f"{thanh_toan_hien_hanh_N - thanh_toan_hien_hanh_N_1:.2f}"
+                        )
+
                 else:
-                    st.error("Lỗi: Không tìm thấy Khóa API. Vui lòng cấu hình Khóa 'GEMINI_API_KEY' trong Streamlit Secrets.")
+                    st.warning("Thiếu chỉ tiêu 'TÀI SẢN NGẮN HẠN' hoặc 'NỢ NGẮN HẠN' để tính chỉ số.")
 
-    except ValueError as ve:
-        st.error(f"Lỗi cấu trúc dữ liệu: {ve}")
-    except Exception as e:
-        st.error(f"Có lỗi xảy ra khi đọc hoặc xử lý file: {e}. Vui lòng kiểm tra định dạng file.")
+                # Bảng đầy đủ các chỉ số trong sổ đăng ký (thiếu chỉ tiêu đầu vào thì hiển thị N/A)
+                st.dataframe(
+                    df_ratios.style.format({ky: '{:.2f}' for ky in periods}, na_rep="N/A"),
+                    use_container_width=True,
+                    hide_index=True
+                )
 
-else:
-    st.info("Vui lòng tải lên file Excel để bắt đầu phân tích.")
+                st.subheader("5. Nhận xét Tình hình Tài chính (AI)")
+
+                col_budget, col_rank = st.columns(2)
+                with col_budget:
+                    token_budget = st.number_input(
+                        "Ngân sách token cho dữ liệu gửi AI",
+                        min_value=500, max_value=100000, value=AI_PROMPT_TOKEN_BUDGET, step=500,
+                        key="ai_token_budget"
+                    )
+                with col_rank:
+                    rank_by = st.radio(
+                        "Khi vượt ngân sách, ưu tiên dòng theo",
+                        options=['weight', 'growth'],
+                        format_func=lambda x: "Tỷ trọng" if x == 'weight' else "Tốc độ tăng trưởng",
+                        horizontal=True,
+                        key="ai_rank_by"
+                    )
+
+                # Dữ liệu gửi AI: CSV gọn, đã làm tròn, cắt theo ngân sách token
+                with trace_span("upload.build_data_for_ai", token_budget=token_budget, rank_by=rank_by):
+                    data_for_ai, prompt_info = build_data_for_ai(
+                        df_processed,
+                        df_ratios,
+                        token_budget=token_budget,
+                        rank_by=rank_by,
+                        protected_rows=line_items['items'].values()
+                    )
+                    annotate_span(**prompt_info)
+                st.caption(
+                    f"📏 Kích thước dữ liệu gửi AI: ~{prompt_info['tokens']:,} token ({prompt_info['chars']:,} ký tự), "
+                    f"{prompt_info['rows_kept']:,}/{prompt_info['rows_total']:,} dòng"
+                )
+
+                if st.button("Yêu cầu AI Phân tích"):
+                    api_key = st.secrets.get("GEMINI_API_KEY")
+                    if api_key:
+                        # Chỉ nộp job vào hàng đợi nền rồi trả về ngay; kết quả được hỏi định kỳ bên dưới
+                        st.session_state.ai_job = submit_ai_analysis(data_for_ai, api_key)
+                    else:
+                        st.error("Lỗi: Không tìm thấy Khóa API. Vui lòng cấu hình Khóa 'GEMINI_API_KEY' trong Streamlit Secrets.")
+
+                job_ref = st.session_state.get("ai_job")
+                # Chỉ hiện job khớp với dữ liệu đang xem (đổi file/ngân sách token thì job cũ không còn liên quan)
+                if job_ref and job_ref['key'] == get_response_cache().make_key(ANALYSIS_MODEL, ANALYSIS_PROMPT_TEMPLATE, data_for_ai):
+                    job = get_ai_job_queue().get(job_ref['id'])
+                    dang_chay = job is not None and job['status'] in AI_JOB_ACTIVE
+                    st.fragment(render_ai_job, run_every=AI_JOB_POLL_SECONDS if dang_chay else None)(job_ref)
+
+        except ValueError as ve:
+            st.error(f"Lỗi cấu trúc dữ liệu: {ve}")
+        except Exception as e:
+            st.error(f"Có lỗi xảy ra khi đọc hoặc xử lý file: {e}. Vui lòng kiểm tra định dạng file.")
+
+    elif che_do_phan_tich == "Một báo cáo":
+        st.session_state.pop("statement_index", None)
+        st.info("Vui lòng tải lên file Excel để bắt đầu phân tích.")
+
+render_analysis_section()
 
 # =================================================================
 # ===================  KHUNG CHAT VỚI GEMINI  =====================
 # =================================================================
 
-st.divider()
-st.header("💬 Khung Chat Gemini (Hỏi–Đáp thời gian thực)")
-
-# Tuỳ chọn model & system prompt
-with st.expander("⚙️ Tuỳ chọn nâng cao", expanded=False):
-    model_name = st.selectbox(
-        "Chọn model Gemini",
-        options=[
-            "gemini-2.5-flash",
-            "gemini-2.0-pro-exp", # Giữ các tùy chọn này để người dùng có thể thử các model khác
-            "gemini-2.0-flash-thinking-exp" 
-        ],
-        index=0,
-        key="chat_model_select"
-    )
-    system_instruction = st.text_area(
-        "System instruction (ngữ cảnh vai trò/trợ lý)",
-        value=(
-            "Bạn là trợ lý AI chuyên nghiệp về tài chính – kế toán – kiểm toán. "
-            "Trả lời ngắn gọn, có cấu trúc, kèm công thức/mẹo nếu cần."
-        ),
-        key="chat_system_instruction"
-    )
-
 # Lưu lịch sử hội thoại
 if "chat_messages" not in st.session_state:
     st.session_state.chat_messages = [
         {"role": "assistant", "content": "Xin chào! Bạn muốn hỏi gì về báo cáo tài chính, IFRS, phân tích chỉ số…?"}
     ]
+# Tóm tắt cuốn chiếu các lượt cũ: nội dung tóm tắt và số lượt (tính trên lịch sử thực) đã gộp vào
+if "chat_summary" not in st.session_state:
+    st.session_state.chat_summary = {"text": "", "count": 0}
 
 def _streamlit_render_messages():
     """Hiển thị lịch sử chat trong giao diện Streamlit."""
@@ -202,75 +916,290 @@ def _streamlit_render_messages():
         with st.chat_message("assistant" if msg["role"] == "assistant" else "user"):
             st.markdown(msg["content"])
 
-def _to_gemini_history(messages, system_instruction_text):
+def _conversation_turns(messages):
+    """Lịch sử thực gửi cho mô hình: bỏ các tin nhắn assistant mở đầu (lời chào, thông báo xoá lịch sử)."""
+    start = 0
+    while start < len(messages) and messages[start]["role"] == "assistant":
+        start += 1
+    return messages[start:]
+
+def _to_gemini_history(messages, context=None):
     """
-    Chuyển lịch sử hội thoại của Streamlit sang định dạng contents cho Google GenAI.
-    Thêm system_instruction dưới dạng một tin nhắn user đặc biệt ở đầu để cung cấp ngữ cảnh.
+    Chuyển các lượt hội thoại của Streamlit sang định dạng contents cho Google GenAI.
+    System instruction và phần tóm tắt không nằm ở đây mà được truyền qua config (xem _chat_system_instruction).
+    context (các dòng báo cáo truy xuất được) chỉ gắn vào lượt hỏi cuối, không lưu vào lịch sử.
     """
-    contents = []
-    # Thêm System Instruction dưới dạng tin nhắn đầu tiên của user (vai trò của mô hình)
-    if system_instruction_text and system_instruction_text.strip():
-        contents.append({"role": "user", "parts": [{"text": f"[System Instruction]\n{system_instruction_text.strip()}"}]})
-    
-    # Thêm lịch sử tin nhắn thực tế
-    for m in messages:
-        role = "user" if m["role"] == "user" else "model"
-        # Bỏ qua tin nhắn chào mừng ban đầu của assistant khi chuyển đổi
-        if m["role"] == "assistant" and m["content"].startswith("Xin chào!"):
-            continue
-            
-        contents.append({"role": role, "parts": [{"text": m["content"]}]})
-        
+    contents = [
+        {"role": "user" if m["role"] == "user" else "model", "parts": [{"text": m["content"]}]}
+        for m in messages
+    ]
+    if context and contents and contents[-1]["role"] == "user":
+        contents[-1]["parts"].insert(0, {"text": context})
     return contents
 
-# Render lịch sử
-_streamlit_render_messages()
-
-# Ô chat input
-user_input = st.chat_input("Nhập câu hỏi cho Gemini…")
-if user_input:
-    # 1. Thêm tin nhắn người dùng vào lịch sử và hiển thị
-    st.session_state.chat_messages.append({"role": "user", "content": user_input})
-    with st.chat_message("user"):
-        st.markdown(user_input)
-
-    api_key = st.secrets.get("GEMINI_API_KEY")
-    if not api_key:
-        with st.chat_message("assistant"):
-            st.error("Chưa cấu hình GEMINI_API_KEY trong st.secrets. Vui lòng kiểm tra lại.")
-    else:
+CHAT_SUMMARY_PROMPT = """Bạn đang nén lịch sử một cuộc hội thoại về tài chính – kế toán để dùng làm ngữ cảnh cho các lượt sau.
+Hãy cập nhật bản tóm tắt (tối đa khoảng 150 từ, tiếng Việt) từ bản tóm tắt cũ và các lượt mới: giữ các câu hỏi chính,
+kết luận, số liệu và giả định người dùng đã nêu; bỏ lời chào và chi tiết thừa.
+
+Bản tóm tắt cũ:
+{summary}
+
+Các lượt mới cần gộp:
+{turns}
+"""
+
+def update_chat_summary(client, model, summary, older_turns):
+    """Gộp các lượt cũ chưa tóm tắt vào bản tóm tắt cuốn chiếu (client là SharedGeminiClient); lỗi khi tóm tắt thì giữ nguyên bản cũ."""
+    new_turns = older_turns[summary["count"]:]
+    if not new_turns:
+        return summary
+
+    prompt = CHAT_SUMMARY_PROMPT.format(
+        summary=summary["text"] or "(chưa có)",
+        turns="\n".join(f"{'Người dùng' if m['role'] == 'user' else 'Trợ lý'}: {m['content']}" for m in new_turns)
+    )
+    cache = get_response_cache()
+    cache_key = cache.make_key(model, CHAT_SUMMARY_PROMPT, prompt)
+    with trace_span("gemini.chat_summary", model=model, prompt_chars=len(prompt), turns=len(new_turns)) as span:
+        text = cache.get(cache_key)
+        span["attributes"]["cache_hit"] = text is not None
+        if text is None:
+            try:
+                text = getattr(client.generate_content(model=model, contents=prompt), "text", None)
+            except APIError as e:
+                span["status"] = "ERROR"
+                span["attributes"]["error"] = f"{type(e).__name__}: {e}"
+                text = None
+            if not text:
+                return summary
+            cache.set(cache_key, text)
+    return {"text": text.strip(), "count": len(older_turns)}
+
+def _chat_system_instruction(system_instruction_text, summary_text):
+    """System instruction gửi qua config gốc của SDK, kèm bản tóm tắt các lượt cũ nếu có."""
+    parts = []
+    if system_instruction_text and system_instruction_text.strip():
+        parts.append(system_instruction_text.strip())
+    if summary_text:
+        parts.append(f"Tóm tắt phần hội thoại trước đó:\n{summary_text}")
+    return "\n\n".join(parts) or None
+
+st.divider()
+st.header("💬 Khung Chat Gemini (Hỏi–Đáp thời gian thực)")
+
+@st.fragment
+@trace_span("ui.chat")
+def render_chat_section():
+    """Khung chat chạy như một fragment: mỗi lượt hỏi–đáp chỉ chạy lại phần chat, không chạy lại quy trình phân tích."""
+    # Tuỳ chọn model & system prompt
+    with st.expander("⚙️ Tuỳ chọn nâng cao", expanded=False):
+        model_name = st.selectbox(
+            "Chọn model Gemini",
+            options=[
+                "gemini-2.5-flash",
+                "gemini-2.0-pro-exp", # Giữ các tùy chọn này để người dùng có thể thử các model khác
+                "gemini-2.0-flash-thinking-exp" 
+            ],
+            index=0,
+            key="chat_model_select"
+        )
+        system_instruction = st.text_area(
+            "System instruction (ngữ cảnh vai trò/trợ lý)",
+            value=(
+                "Bạn là trợ lý AI chuyên nghiệp về tài chính – kế toán – kiểm toán. "
+                "Trả lời ngắn gọn, có cấu trúc, kèm công thức/mẹo nếu cần."
+            ),
+            key="chat_system_instruction"
+        )
+        chat_history_budget = st.number_input(
+            "Ngân sách token cho lịch sử chat gửi kèm (phần cũ hơn được tóm tắt)",
+            min_value=200, max_value=32000, value=CHAT_HISTORY_TOKEN_BUDGET, step=200,
+            key="chat_history_budget"
+        )
+        use_statement = st.checkbox(
+            "Gửi kèm các dòng liên quan từ báo cáo đã tải lên",
+            value=True,
+            key="chat_use_statement"
+        )
+        statement = st.session_state.get("statement_index")
+        if statement:
+            st.caption(f"📑 Đã lập chỉ mục {len(statement['index']['texts']):,} dòng từ {statement['source']}.")
+        render_cache_stats()
+        render_job_stats()
         try:
-            client = genai.Client(api_key=api_key)
-            # Chuyển đổi lịch sử chat
-            contents = _to_gemini_history(st.session_state.chat_messages, system_instruction)
-            
-            # 2. Gọi API và hiển thị phản hồi
+            stats_api_key = st.secrets.get("GEMINI_API_KEY")
+        except FileNotFoundError:
+            stats_api_key = None
+        if stats_api_key:
+            render_client_stats(stats_api_key)
+
+    # Render lịch sử
+    _streamlit_render_messages()
+
+    # Ô chat input
+    user_input = st.chat_input("Nhập câu hỏi cho Gemini…")
+    if user_input:
+        # 1. Thêm tin nhắn người dùng vào lịch sử và hiển thị
+        st.session_state.chat_messages.append({"role": "user", "content": user_input})
+        with st.chat_message("user"):
+            st.markdown(user_input)
+
+        api_key = st.secrets.get("GEMINI_API_KEY")
+        if not api_key:
             with st.chat_message("assistant"):
-                with st.spinner("Gemini đang soạn trả lời…"):
-                    resp = client.models.generate_content(
-                        model=model_name,
-                        contents=contents
-                    )
-                    # Lấy nội dung hoặc thông báo lỗi nếu có
-                    answer = getattr(resp, "text", None) or "Không nhận được nội dung từ mô hình."
-                    st.markdown(answer)
-                    # 3. Lưu phản hồi của AI vào lịch sử
+                st.error("Chưa cấu hình GEMINI_API_KEY trong st.secrets. Vui lòng kiểm tra lại.")
+        else:
+            try:
+                client = get_gemini_client(api_key)
+                # Giữ nguyên văn các lượt gần đây trong ngân sách token, gộp phần cũ hơn vào bản tóm tắt cuốn chiếu
+                turns = _conversation_turns(st.session_state.chat_messages)
+                older_turns, recent_turns = split_chat_history(
+                    turns, chat_history_budget, st.session_state.chat_summary["count"]
+                )
+                if len(older_turns) > st.session_state.chat_summary["count"]:
+                    with st.spinner("Đang tóm tắt phần hội thoại cũ…"):
+                        st.session_state.chat_summary = update_chat_summary(
+                            client, model_name, st.session_state.chat_summary, older_turns
+                        )
+                    if st.session_state.chat_summary["count"] < len(older_turns):
+                        # Tóm tắt thất bại: gửi nguyên văn các lượt chưa tóm tắt để mô hình không mất ngữ cảnh
+                        recent_turns = turns[st.session_state.chat_summary["count"]:]
+                # Chỉ gửi kèm top-k dòng báo cáo gần câu hỏi nhất thay vì cả bảng
+                hits = []
+                if use_statement and statement:
+                    with trace_span("chat.retrieval", rows=len(statement['index']['texts'])) as span:
+                        hits = search_statement_index(statement['index'], user_input)
+                        span["attributes"].update(hits=len(hits), top_score=round(hits[0][0], 3) if hits else 0.0)
+                contents = _to_gemini_history(
+                    recent_turns, retrieval_context(statement['source'], hits) if hits else None
+                )
+                chat_instruction = _chat_system_instruction(system_instruction, st.session_state.chat_summary["text"])
+
+                # 2. Gọi API dạng streaming và hiển thị từng đoạn ngay khi nhận được
+                with st.chat_message("assistant"):
+                    cache = get_response_cache()
+                    prompt_parts = [chat_instruction or ""] + [part["text"] for c in contents for part in c["parts"]]
+                    prompt_chars = sum(map(len, prompt_parts))
+                    prompt_tokens = sum(map(estimate_tokens, prompt_parts))
+                    answer = st.write_stream(traced_stream(
+                        "gemini.chat",
+                        stream_with_cache(
+                            cache,
+                            cache.make_key(model_name, chat_instruction, contents),
+                            lambda: client.generate_content_stream(
+                                model=model_name,
+                                contents=contents,
+                                config=types.GenerateContentConfig(system_instruction=chat_instruction)
+                            )
+                        ),
+                        model=model_name, prompt_chars=prompt_chars, prompt_tokens_est=prompt_tokens,
+                        history_turns=len(recent_turns)
+                    ))
+                    # Lấy nội dung hoặc thông báo nếu mô hình không trả về gì
+                    if not answer:
+                        answer = "Không nhận được nội dung từ mô hình."
+                        st.markdown(answer)
+                    if hits:
+                        st.caption(f"📎 Đã gửi kèm {len(hits)} dòng liên quan từ {statement['source']}.")
+                    # 3. Lưu phản hồi hoàn chỉnh của AI vào lịch sử khi luồng kết thúc
                     st.session_state.chat_messages.append({"role": "assistant", "content": answer})
 
-        except APIError as e:
-            with st.chat_message("assistant"):
-                st.error(f"Lỗi gọi Gemini API: {e}. Vui lòng kiểm tra Khóa API.")
-        except Exception as e:
-            with st.chat_message("assistant"):
-                st.error(f"Đã xảy ra lỗi không xác định: {e}")
-        # Buộc rerun để cập nhật khung chat ngay lập tức
-        st.rerun()
+            except APIError as e:
+                with st.chat_message("assistant"):
+                    st.error(f"Lỗi gọi Gemini API: {e}. Vui lòng kiểm tra Khóa API.")
+            except Exception as e:
+                with st.chat_message("assistant"):
+                    st.error(f"Đã xảy ra lỗi không xác định: {e}")
 
-# Nút xoá lịch sử chat
-col_reset, _ = st.columns([1, 5])
-with col_reset:
-    if st.button("🧹 Xoá lịch sử chat"):
-        st.session_state.chat_messages = [
-            {"role": "assistant", "content": "Lịch sử đã được xoá. Bạn cần hỏi gì, cứ nhắn mình nhé!"}
-        ]
+    # Nút xoá lịch sử chat
+    col_reset, _ = st.columns([1, 5])
+    with col_reset:
+        if st.button("🧹 Xoá lịch sử chat"):
+            st.session_state.chat_messages = [
+                {"role": "assistant", "content": "Lịch sử đã được xoá. Bạn cần hỏi gì, cứ nhắn mình nhé!"}
+            ]
+            st.session_state.chat_summary = {"text": "", "count": 0}
+            st.rerun(scope="fragment")
+
+render_chat_section()
+
+# ------------------- THANH BÊN GỠ LỖI HIỆU NĂNG -------------------
+# Dừng profiler (nếu lần chạy này được yêu cầu profile) trước khi vẽ thanh bên để kết quả không lẫn phần gỡ lỗi
+_active_profiler = st.session_state.pop("active_profiler", None)
+if _active_profiler is not None:
+    _active_profiler.disable()
+    st.session_state.last_profile = save_profile(_active_profiler)
+
+def traces_to_frame(traces):
+    """Bảng các span (trace mới nhất trước), thụt lề theo độ sâu để thấy bước nào nằm trong bước nào."""
+    rows = []
+    for spans in reversed(traces):
+        root = spans[0]
+        lan_chay = f"{root['name']} @ {time.strftime('%H:%M:%S', time.localtime(root['start_time_unix_nano'] / 1e9))}"
+        for span in spans:
+            attrs = dict(span["attributes"])
+            rows.append({
+                'Lần chạy': lan_chay,
+                'Bước': "· " * span["depth"] + span["name"],
+                'Thời gian (ms)': span["duration_ms"],
+                'TTFB (ms)': attrs.pop("ttfb_ms", None),
+                'Prompt (ký tự)': attrs.pop("prompt_chars", None),
+                'Trạng thái': span["status"],
+                'Thuộc tính': json.dumps(attrs, ensure_ascii=False, default=str) if attrs else "",
+            })
+    return pd.DataFrame(rows)
+
+@st.fragment
+def render_debug_panel():
+    """Thanh bên gỡ lỗi: thời gian từng bước của các lần chạy gần đây, xuất trace và profile một lần chạy."""
+    st.header("🐞 Gỡ lỗi hiệu năng")
+    traces = st.session_state.get("trace_history", [])
+
+    col_refresh, col_clear = st.columns(2)
+    with col_refresh:
+        st.button("🔄 Làm mới", use_container_width=True)
+    with col_clear:
+        if st.button("🧹 Xoá trace", use_container_width=True):
+            traces.clear()
+
+    if traces:
+        st.dataframe(traces_to_frame(traces), use_container_width=True, hide_index=True)
+        st.download_button(
+            "⬇️ Trace (JSON Lines)",
+            data="\n".join(json.dumps(span, ensure_ascii=False, default=str) for spans in traces for span in spans),
+            file_name="traces.jsonl",
+            mime="application/x-ndjson"
+        )
+        st.download_button(
+            "⬇️ Trace (OTLP JSON)",
+            data=json.dumps(traces_to_otlp(traces), ensure_ascii=False),
+            file_name="traces.otlp.json",
+            mime="application/json"
+        )
+    else:
+        st.info("Chưa có trace nào trong phiên này.")
+    if TRACE_LOG_PATH:
+        st.caption(f"Trace cũng được ghi vào `{TRACE_LOG_PATH}`.")
+
+    st.subheader("cProfile")
+    if st.button("Profile lần chạy kế tiếp"):
+        st.session_state.profile_next_run = True
         st.rerun()
+    last_profile = st.session_state.get("last_profile")
+    if last_profile:
+        st.caption(f"Kết quả lần profile gần nhất: `{last_profile['path']}`")
+        with st.expander("Các hàm tốn thời gian nhất (cumulative)"):
+            st.code(last_profile['text'], language=None)
+        if os.path.exists(last_profile['path']):
+            with open(last_profile['path'], 'rb') as f:
+                st.download_button(
+                    "⬇️ File .prof (xem bằng snakeviz)",
+                    data=f.read(),
+                    file_name=os.path.basename(last_profile['path']),
+                    mime="application/octet-stream"
+                )
+
+# Bật bằng biến môi trường DEBUG_PANEL=1 hoặc thêm ?debug=1 vào URL
+if DEBUG_PANEL or st.query_params.get("debug") == "1":
+    with st.sidebar:
+        render_debug_panel()